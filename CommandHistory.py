@@ -1,29 +1,807 @@
-import re
-from common import fuzzy_match
+import re, os, time, threading
+from array import array
+from itertools import chain
+from fuzzy import WordsPattern, alignment_score
 
-class CommandHistory:
+# The time (in seconds) after which a use of a command counts half as much in
+# the 'frecency' ranking
+frecency_half_life = 7 * 24 * 3600
+
+class CommandHistory(object):
     """
     Handle all things related to managing and navigating the command history
     """
     def __init__(self):
-        # The actual command list
-        self.list = []
-
         # The current search filter
         self.filter = ''
 
-        # A filtered list based on the current filter
+        # Compiled search patterns for the current filter
+        self.matcher = None
+
+        # Matches of the current filter, generated (strongest first) as we
+        # navigate back in the history; these are (line, tier) pairs, the
+        # tier being the index of the strongest matching pattern
+        self.results = None
+
+        # Spans of the filter words in the visited matches, computed when
+        # the match becomes current
+        self.spans = {}
+
+        # Matches to revisit when navigating back (i.e. the ones we left
+        # while navigating forward), the next one is last
         self.filtered_list = []
 
-        # A trail of visited indices (while navigating)
+        # A trail of visited matches (while navigating)
         self.trail = []
 
+        # Pre-filters applied by start() before matching the filter: only look
+        # at the commands run in a given directory and/or the successful ones
+        self.only_cwd = None
+        self.only_successful = False
+
+        # How start() orders the matches: 'recency' (strongest match first,
+        # then newest first) or 'frecency' (by match strength combined with
+        # how often and how recently the command was run)
+        self.ranking = 'recency'
+
+        # A directory whose commands start() returns before the others
+        self.first_cwd = None
+
+        # Lines dropped from the history, searched after all the others (e.g.
+        # a HistoryArchive); segments() returns the segments, newest first,
+        # as sequences of lines that are closed once searched
+        self.archive = None
+
+        # Background search: if search_budget is set, the matches are looked
+        # up by a HistorySearch thread started by start(), and up() waits at
+        # most that many seconds for the next one; notify is called (from the
+        # search thread) when a match that up() gave up on becomes available.
+        # The thread must stop (see cancel()) before the history is changed
+        self.search_budget = None
+        self.notify = None
+        self.searcher = None
+        self.cancelled = False
+
+        # The strongest match found so far by the search (None until one is
+        # found), shown by up() while waiting for the first match
+        self.best = None
+
+        # Whether up() is waiting for a match (see refresh()), and whether the
+        # last entry in the trail is the provisional best match
+        self.pending = False
+        self.provisional = False
+
+        # The actual command list. The lines of the loaded history (possibly a
+        # lazily decoded HistoryStore) have stamps 0..store_size-1, each line
+        # added since then gets a new stamp; stamps increase monotonically, so
+        # they give the order of the lines (a line that is added again leaves
+        # a hole behind)
+        self.store = []
+        self.store_size = 0
+        self.stamps = {}        # Lines added since the load -> stamp
+        self.lines = {}         # Stamp -> line added since the load
+        self.next_stamp = 0
+
+        # Inverted index: lowercase trigram -> (ascending) stamps of the lines
+        # containing it; stamps of removed lines are left in and skipped. The
+        # loaded lines are only indexed by the first search (store_indexing is
+        # where a cancelled indexing stopped)
+        self.index = {}
+        self.store_indexed = True
+        self.store_indexing = None
+        self.stale_stamps = 0
+
+        # Words and candidates of the last search; a search for a more
+        # specific filter only needs to look at these
+        self.cached_words = None
+        self.cached_candidates = []
+
+        # What we know about the commands, in parallel arrays indexed by stamp
+        # (see set_info()); a HistoryStore may also provide this for the
+        # loaded lines
+        self.info_dirs = []
+        self.info_dir_ids = {}
+        self.info_dir = array('i')
+        self.info_exit = array('i')
+        self.info_duration = array('f')
+        self.info_time = array('d')
+        self.info_uses = array('d')
+
+        # Directory index: index in info_dirs -> (ascending) stamps of the
+        # commands run there (like the trigram index)
+        self.dir_index = {}
+
+    def line_at(self, stamp):
+        """Return the line with the given stamp (None if it was moved)"""
+        if stamp < self.store_size:
+            line = self.store[stamp]
+            # Loaded lines that were added again have a newer stamp
+            return None if line in self.stamps else line
+        return self.lines.get(stamp)
+
+    def set_info(self, stamp, info, uses = None):
+        """
+        Record what we know about the command with the given stamp, as a
+        (cwd, exit code, duration, start time) tuple (or None if unknown),
+        and how many times it was run (decayed as of the start time, see
+        frecency())
+        """
+        missing = stamp + 1 - len(self.info_dir)
+        if missing > 0:
+            self.info_dir.extend([-1] * missing)
+            self.info_exit.extend([0] * missing)
+            self.info_duration.extend([0] * missing)
+            self.info_time.extend([0] * missing)
+            self.info_uses.extend([0] * missing)
+        if info is None:
+            self.info_dir[stamp] = -1
+            return
+        (cwd, exit_code, duration, start_time) = info
+        key = os.path.normcase(cwd)
+        if not key in self.info_dir_ids:
+            self.info_dir_ids[key] = len(self.info_dirs)
+            self.info_dirs.append(cwd)
+        self.info_dir[stamp] = self.info_dir_ids[key]
+        if self.info_dir[stamp] in self.dir_index:
+            self.dir_index[self.info_dir[stamp]].append(stamp)
+        else:
+            self.dir_index[self.info_dir[stamp]] = array('i', [stamp])
+        self.info_exit[stamp] = exit_code
+        self.info_duration[stamp] = duration
+        self.info_time[stamp] = start_time
+        self.info_uses[stamp] = uses if uses is not None else 1
+
+    def info_at(self, stamp):
+        """Return what we know about the command with the given stamp (or None)"""
+        if stamp < len(self.info_dir) and self.info_dir[stamp] >= 0:
+            return (self.info_dirs[self.info_dir[stamp]], self.info_exit[stamp],
+                    self.info_duration[stamp], self.info_time[stamp])
+        if stamp < self.store_size and hasattr(self.store, 'info'):
+            return self.store.info(stamp)
+        return None
+
+    def uses_at(self, stamp):
+        """
+        Return how many times the command with the given stamp was run, decayed
+        as of its last run (0 if unknown)
+        """
+        if stamp < len(self.info_dir) and self.info_dir[stamp] >= 0:
+            return self.info_uses[stamp]
+        if stamp < self.store_size and hasattr(self.store, 'uses'):
+            return self.store.uses(stamp)
+        return 0
+
+    def frecency(self, stamp, now):
+        """
+        Return the frecency of the command with the given stamp: each run
+        counts as 1, halved every frecency_half_life seconds since
+        """
+        info = self.info_at(stamp)
+        if info is None:
+            return 0
+        return self.uses_at(stamp) * 0.5 ** (max(now - info[3], 0) / frecency_half_life)
+
+    def last_info(self):
+        """Return what we know about the most recently added line (or None)"""
+        return self.info_at(self.next_stamp - 1) if self.next_stamp else None
+
+    def last_uses(self):
+        """Return how many times the most recently added line was run (see uses_at())"""
+        return self.uses_at(self.next_stamp - 1) if self.next_stamp else 0
+
+    def prefilter(self, candidates):
+        """Keep the (stamp, line) candidates that pass the pre-filters"""
+        cwd = os.path.normcase(self.only_cwd) if self.only_cwd is not None else None
+        cwd_id = self.info_dir_ids.get(cwd, -2)
+        result = []
+        for (stamp, line) in candidates:
+            if self.cancelled:
+                return []
+            if stamp < len(self.info_dir) and self.info_dir[stamp] >= 0:
+                # Fast path, look at the arrays only
+                if cwd is not None and self.info_dir[stamp] != cwd_id:
+                    continue
+                if self.only_successful and self.info_exit[stamp] != 0:
+                    continue
+            else:
+                info = self.info_at(stamp)
+                if info is None:
+                    continue
+                if cwd is not None and os.path.normcase(info[0]) != cwd:
+                    continue
+                if self.only_successful and info[1] != 0:
+                    continue
+            result.append((stamp, line))
+        return result
+
+    def get_list(self):
+        """Return the lines in the history, oldest first"""
+        lines = [self.line_at(stamp) for stamp in xrange(self.next_stamp)]
+        return [line for line in lines if line is not None]
+
+    def newest_first(self):
+        """Iterate over the lines in the history, newest first"""
+        for stamp in xrange(self.next_stamp - 1, -1, -1):
+            line = self.line_at(stamp)
+            if line is not None:
+                yield line
+
+    def last(self):
+        """Return the most recently added line (None for an empty history)"""
+        return self.line_at(self.next_stamp - 1) if self.next_stamp else None
+
+    def load(self, lines, infos = None, uses = None):
+        """
+        Replace the history with the given lines, oldest first; these can be
+        any sequence of unique lines (e.g. a HistoryStore), which is only read
+        when needed. The infos are what we know about the commands and the uses
+        how many times they were run (see set_info()), in the same order.
+        """
+        self.reset()
+        if infos is None:
+            infos = []
+        if uses is None:
+            uses = [None] * len(infos)
+        if isinstance(lines, list) and len(set(lines)) < len(lines):
+            # Only keep the last occurrence of each line
+            infos = infos + [None] * (len(lines) - len(infos))
+            uses = uses + [None] * (len(lines) - len(uses))
+            seen = set()
+            unique = [i for i in xrange(len(lines) - 1, -1, -1)
+                      if not (lines[i] in seen or seen.add(lines[i]))]
+            unique.reverse()
+            lines = [lines[i] for i in unique]
+            infos = [infos[i] for i in unique]
+            uses = [uses[i] for i in unique]
+        self.store = lines
+        self.store_size = len(lines)
+        self.stamps = {}
+        self.lines = {}
+        self.next_stamp = self.store_size
+        self.index = {}
+        self.store_indexed = False
+        self.store_indexing = None
+        self.stale_stamps = 0
+        self.cached_words = None
+        self.cached_candidates = []
+        self.info_dirs = []
+        self.info_dir_ids = {}
+        self.info_dir = array('i')
+        self.info_exit = array('i')
+        self.info_duration = array('f')
+        self.info_time = array('d')
+        self.info_uses = array('d')
+        self.dir_index = {}
+        for stamp in xrange(len(infos)):
+            if infos[stamp] is not None:
+                self.set_info(stamp, infos[stamp], uses[stamp])
+
+    list = property(get_list, load)
+
+    def index_store(self):
+        """
+        Add the loaded lines to the indices (before the lines added since); if
+        the store also knows about the commands, this is copied to the arrays.
+
+        Return False if the search is cancelled before the end; the next call
+        resumes from there.
+        """
+        if self.store_indexing is None:
+            self.store_indexing = (0, {}, {})
+        (start, index, store_dir_index) = self.store_indexing
+        dir_index = self.dir_index
+        self.dir_index = store_dir_index
+        has_entries = hasattr(self.store, 'entry')
+        for stamp in xrange(start, self.store_size):
+            if self.cancelled:
+                self.store_indexing = (stamp, index, self.dir_index)
+                self.dir_index = dir_index
+                return False
+            if has_entries:
+                (line, info, uses) = self.store.entry(stamp)
+                if info is not None:
+                    self.set_info(stamp, info, uses)
+            else:
+                line = self.store[stamp]
+            for trigram in trigrams(line.lower()):
+                if trigram in index:
+                    index[trigram].append(stamp)
+                else:
+                    index[trigram] = array('i', [stamp])
+        for (trigram, stamps) in self.index.iteritems():
+            if trigram in index:
+                index[trigram].extend(stamps)
+            else:
+                index[trigram] = stamps
+        for (dir_id, stamps) in dir_index.iteritems():
+            if dir_id in self.dir_index:
+                self.dir_index[dir_id].extend(stamps)
+            else:
+                self.dir_index[dir_id] = stamps
+        self.index = index
+        self.store_indexed = True
+        self.store_indexing = None
+        return True
+
+    def index_line(self, line):
+        """Stamp a (new or moved) line and add its trigrams to the index"""
+        if line in self.stamps:
+            del self.lines[self.stamps[line]]
+            self.stale_stamps += 1
+        stamp = self.next_stamp
+        self.next_stamp += 1
+        self.stamps[line] = stamp
+        self.lines[stamp] = line
+        for trigram in trigrams(line.lower()):
+            if trigram in self.index:
+                self.index[trigram].append(stamp)
+            else:
+                self.index[trigram] = array('i', [stamp])
+
+    def find(self, line):
+        """
+        Return the stamp of a line in the history (None if not there); until a
+        search indexed the loaded lines, these are looked up in the store
+        itself (so that adding a line never waits for the whole store to be
+        indexed)
+        """
+        if line in self.stamps:
+            return self.stamps[line]
+        if not self.store_size:
+            return None
+        if not self.store_indexed:
+            if hasattr(self.store, 'find'):
+                return self.store.find(line)
+            try:
+                return self.store.index(line)
+            except ValueError:
+                return None
+        postings = [self.index.get(t, ()) for t in trigrams(line.lower())]
+        if postings:
+            stamps = reversed(min(postings, key=len))
+        else:
+            stamps = xrange(self.store_size - 1, -1, -1)
+        for stamp in stamps:
+            if stamp < self.store_size and self.line_at(stamp) == line:
+                return stamp
+        return None
+
+    def candidates(self, words):
+        """
+        Return the (stamp, line) pairs of the lines (newest first) that contain
+        all the given words (ignoring case); this is a superset of the lines
+        matched by any of the search patterns built by start()
+        """
+        if not self.store_indexed and not self.index_store():
+            return []
+        words = [w.lower() for w in words]
+        postings = [self.index.get(t, ()) for w in words for t in trigrams(w)]
+        rarest = min(postings, key=len) if postings else None
+        if (self.cached_words is not None
+            and all([any([c in w for w in words]) for c in self.cached_words])
+            and (rarest is None or len(self.cached_candidates) <= len(rarest))):
+            # Each of the previous words is part of a current word (e.g. the
+            # filter was extended), so the previous candidates still contain
+            # all the lines that can match; narrow them down
+            lines = self.cached_candidates
+        elif rarest is not None:
+            # Only look at the lines sharing the rarest trigram of the filter
+            lines = ((stamp, self.line_at(stamp)) for stamp in reversed(rarest))
+        else:
+            # Filter too short for the index, check every line
+            lines = ((stamp, self.line_at(stamp))
+                     for stamp in xrange(self.next_stamp - 1, -1, -1))
+
+        result = []
+        for (stamp, line) in lines:
+            if self.cancelled:
+                return []
+            if line is not None:
+                line_lower = line.lower()
+                if all([w in line_lower for w in words]):
+                    result.append((stamp, line))
+
+        self.cached_words = words
+        self.cached_candidates = result
+        return result
+
+    def dir_candidates(self, cwd, words):
+        """
+        Return the (stamp, line) pairs of the commands run in a directory
+        (newest first) that contain all the given words (ignoring case)
+        """
+        if not self.store_indexed and not self.index_store():
+            return []
+        words = [w.lower() for w in words]
+        dir_id = self.info_dir_ids.get(os.path.normcase(cwd))
+        result = []
+        for stamp in reversed(self.dir_index.get(dir_id, ())):
+            if self.cancelled:
+                return []
+            line = self.line_at(stamp)
+            if line is not None:
+                line_lower = line.lower()
+                if all([w in line_lower for w in words]):
+                    result.append((stamp, line))
+        return result
+
+    def matching_candidates(self):
+        """
+        Return the (stamp, line) pairs of the lines that can match the current
+        filter (newest first), after applying the pre-filters
+        """
+        # Every pattern requires the alphanumeric words of the filter (or the
+        # entire filter) to be present, so the index gives us all the lines
+        # that can possibly match
+        if self.only_cwd is not None:
+            candidates = self.dir_candidates(self.only_cwd, self.matcher.required_words)
+        else:
+            candidates = self.candidates(self.matcher.required_words)
+        if self.only_cwd is not None or self.only_successful:
+            candidates = self.prefilter(candidates)
+        return candidates
+
     def start(self, line):
         """
         Start history navigation
         """
         #print '\n\nStart\n\n'
+        self.cancel()
         self.filter = line
+        self.matcher = HistoryMatcher(line)
+
+        # The matches are only looked up when navigating to them (or in the
+        # background)
+        self.filtered_list = []
+        self.results = self.matches()
+        self.best = None
+        self.pending = False
+        self.provisional = False
+        if self.search_budget is not None:
+            self.searcher = HistorySearch(self.results, self.notify)
+            self.results = None
+        self.spans = {}
+
+        # We use the trail to navigate back in the same order; the filter
+        # itself is highlighted entirely
+        self.trail = [(self.filter, None)]
+
+    def matches(self):
+        """
+        Generate the (line, tier) matches of the current filter, in the order
+        in which we navigate to them
+        """
+        if self.first_cwd is None:
+            results = self.search(self.matching_candidates())
+        else:
+            # Matches of the commands run in the directory first; the others
+            # are only looked for once we get past these
+            candidates = self.dir_candidates(self.first_cwd, self.matcher.required_words)
+            if self.only_cwd is not None or self.only_successful:
+                candidates = self.prefilter(candidates)
+            results = chain(self.search(candidates),
+                            self.search_others(set([c[0] for c in candidates])))
+        if self.archive is not None:
+            results = chain(results, self.search_archive())
+        for match in results:
+            yield match
+
+    def search(self, candidates):
+        """
+        Generate the (line, tier) matches of the current filter among the
+        candidate lines: all the lines matching the strongest pattern,
+        newest first, then the ones matching the second pattern etc. (see
+        HistoryMatcher.order() for the weakest patterns).
+
+        Each candidate is classified by its strongest matching pattern in a
+        single pass; matches of the first pattern are returned right away,
+        as no other match can come before them.
+        """
+        if self.ranking == 'frecency':
+            for match in self.rank(candidates):
+                yield match
+            return
+
+        tiers = [[] for pattern in self.matcher.patterns]
+        for (stamp, line) in candidates:
+            if self.cancelled:
+                return
+            tier = self.matcher.classify(line)
+            if tier == 0:
+                yield (line, tier)
+            elif tier is not None:
+                tiers[tier].append(line)
+                if self.best is None or tier < self.best[1]:
+                    self.best = (line, tier)
+
+        for tier in range(1, len(tiers)):
+            for line in self.matcher.order(tiers[tier], tier):
+                yield (line, tier)
+
+    def search_others(self, stamps):
+        """Generate the matches of the current filter, except the given stamps"""
+        candidates = [c for c in self.matching_candidates() if not c[0] in stamps]
+        for match in self.search(candidates):
+            yield match
+
+    def search_archive(self):
+        """
+        Generate the matches of the current filter in the archive, segment by
+        segment (newest first), strongest pattern first within each segment;
+        lines that are still in the history, or in a newer segment, are
+        skipped. Only the matches of one segment are kept in memory.
+        """
+        words = [w.lower() for w in self.matcher.required_words]
+        cwd = os.path.normcase(self.only_cwd) if self.only_cwd is not None else None
+        seen = set()
+        for segment in self.archive.segments():
+            tiers = [[] for pattern in self.matcher.patterns]
+            for index in xrange(len(segment) - 1, -1, -1):
+                if self.cancelled:
+                    return
+                (line, info, uses) = segment.entry(index)
+                line_lower = line.lower()
+                if line in seen or not all([w in line_lower for w in words]):
+                    continue
+                seen.add(line)
+                if cwd is not None or self.only_successful:
+                    if info is None:
+                        continue
+                    if cwd is not None and os.path.normcase(info[0]) != cwd:
+                        continue
+                    if self.only_successful and info[1] != 0:
+                        continue
+                tier = self.matcher.classify(line)
+                if tier is not None and self.find(line) is None:
+                    tiers[tier].append(line)
+            segment.close()
+            for tier in range(len(tiers)):
+                for line in self.matcher.order(tiers[tier], tier):
+                    yield (line, tier)
+
+    def rank(self, candidates):
+        """
+        Return the (line, tier) matches of the current filter among the
+        candidate lines, ordered by their score: the weight of the tier
+        (halved for each weaker pattern) times 1 + the frecency of the line;
+        ties are ordered newest first
+        """
+        now = time.time()
+        scored = []
+        best = None
+        for (stamp, line) in candidates:
+            if self.cancelled:
+                return []
+            tier = self.matcher.classify(line)
+            if tier is not None:
+                score = 0.5 ** tier * (1 + self.frecency(stamp, now))
+                scored.append((-score, len(scored), line, tier))
+                if best is None or score > best:
+                    best = score
+                    self.best = (line, tier)
+        scored.sort()
+        return [(line, tier) for (score, order, line, tier) in scored]
+
+    def up(self):
+        """
+        Navigate back in the command history; in a background search, return
+        None if the next match is not found within the search budget (see
+        refresh())
+        """
+        if self.filtered_list:
+            self.trail.append(self.filtered_list.pop())
+            return True
+        if self.pending:
+            return self.refresh(self.search_budget)
+        if self.searcher is not None:
+            match = self.searcher.get(len(self.trail) - 1, self.search_budget)
+            if match is False:
+                # Show the best match so far in the meantime
+                self.pending = True
+                if len(self.trail) == 1 and self.best is not None:
+                    self.trail.append(self.best)
+                    self.provisional = True
+                return None
+        else:
+            match = next(self.results, None) if self.results else None
+        if match:
+            # Look up the next match
+            self.trail.append(match)
+            return True
+        else:
+            return False
+
+    def refresh(self, timeout = 0):
+        """
+        Move to the match that up() gave up waiting for if it was found since
+        (waiting at most timeout seconds for it), replacing the provisional
+        match; return True if moved, False if the search ended without finding
+        it and None if still waiting
+        """
+        if not self.pending:
+            return None
+        match = self.searcher.get(len(self.trail) - 1 - self.provisional, timeout)
+        if match is False:
+            return None
+        self.pending = False
+        if self.provisional:
+            self.trail.pop()
+            self.provisional = False
+        if match is None:
+            return False
+        self.trail.append(match)
+        return True
+
+    def down(self):
+        """
+        Navigate forward in the command history
+        """
+        if self.pending:
+            # Stop waiting for the next match
+            self.pending = False
+            if self.provisional:
+                self.trail.pop()
+                self.provisional = False
+                return True
+        if self.trail:
+            self.filtered_list.append(self.trail.pop())
+            return True
+        else:
+            return False
+
+    def cancel(self):
+        """Stop the background search (if any)"""
+        if self.searcher is not None:
+            # No news once the search sees that it is cancelled
+            self.searcher.cancel()
+            self.cancelled = True
+            self.searcher.thread.join()
+            self.cancelled = False
+            self.searcher = None
+
+    def reset(self):
+        """Reset browsing through the history"""
+        self.cancel()
+        self.best = None
+        self.pending = False
+        self.provisional = False
+        self.filter = ''
+        self.matcher = None
+        self.results = None
+        self.spans = {}
+        self.filtered_list = []
+        self.trail = []
+
+    def add(self, line, info = None, uses = None):
+        """
+        Add a new line to the history, with what we know about the command
+        (see set_info()) if it was run; a line added again without it keeps the
+        previous info. Unless specified, the number of uses is updated from the
+        previous one.
+        """
+        if line:
+            #print 'Adding "' + line + '"'
+            self.cancel()
+            stamp = self.find(line) if info is None or uses is None else None
+            if stamp is not None:
+                if info is None:
+                    # Not run this time
+                    info = self.info_at(stamp)
+                    uses = self.uses_at(stamp)
+                elif self.info_at(stamp) is not None:
+                    uses = self.frecency(stamp, info[3]) + 1
+            self.index_line(line)
+            if info is not None:
+                self.set_info(self.next_stamp - 1, info, uses)
+            if self.stale_stamps > self.next_stamp - self.stale_stamps:
+                # Too many moved lines, compact the history
+                stamps = [stamp for stamp in xrange(self.next_stamp)
+                          if self.line_at(stamp) is not None]
+                indexed = self.store_indexed
+                self.load([self.line_at(stamp) for stamp in stamps],
+                          [self.info_at(stamp) for stamp in stamps],
+                          [self.uses_at(stamp) for stamp in stamps])
+                if indexed:
+                    self.index_store()
+            self.cached_words = None
+            self.reset()
+
+    def current(self):
+        """Return the current history item and the spans of the filter words"""
+        if not self.trail:
+            return ('', [])
+        (line, tier) = self.trail[-1]
+        if tier is None:
+            return (line, [(0, len(line))])
+        if not line in self.spans:
+            self.spans[line] = self.matcher.spans(line, tier)
+        return (line, self.spans[line])
+
+
+class HistorySearch(object):
+    """
+    Collect the matches of a history search in a background thread
+    """
+    def __init__(self, results, notify = None):
+        """Start the thread, looking up the matches generated by results"""
+        self.matches = []
+        self.done = False
+        self.waiting = False
+        self.notify = notify
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, args=(results,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, results):
+        """Thread function: add the matches as they are found"""
+        try:
+            for match in results:
+                self.update(match)
+        except Exception, e:
+            # Not much we can do, keep what was found so far
+            pass
+        self.update(None)
+
+    def update(self, match):
+        """Add a match (None once the search is over) and wake up the waiters"""
+        self.condition.acquire()
+        try:
+            if match is None:
+                self.done = True
+            else:
+                self.matches.append(match)
+            self.condition.notifyAll()
+            notify = self.notify if self.waiting else None
+            self.waiting = False
+        finally:
+            self.condition.release()
+        if notify:
+            notify()
+
+    def cancel(self):
+        """
+        Stop waiting for news: once the search is cancelled, notify is never
+        called (e.g. while a command runs, the key written by PyCmd's notify
+        function would be read by the command)
+        """
+        self.condition.acquire()
+        try:
+            self.waiting = False
+            self.notify = None
+        finally:
+            self.condition.release()
+
+    def get(self, index, timeout = 0):
+        """
+        Return the match with the given index, waiting at most timeout seconds
+        for it; return None if the search ended without finding it, or False if
+        it is not found yet (notify is then called once there is news)
+        """
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while index >= len(self.matches) and not self.done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting = True
+                    return False
+                self.condition.wait(remaining)
+            if index < len(self.matches):
+                return self.matches[index]
+            return None
+        finally:
+            self.condition.release()
+
+
+class HistoryMatcher(object):
+    """
+    The search patterns for a history filter, compiled once per search
+    """
+    def __init__(self, line):
+        # The index of the first pattern whose matches are ordered by the
+        # score of their spans (see order())
+        self.fuzzy_tier = None
 
         # Create a list of regex patterns to use when navigating the history
         # using a filter
@@ -41,7 +819,9 @@ class CommandHistory:
         ]
 
         # B. Then split based on other separator characters as well
-        words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)] # Split the filter into words
+        words = re.findall('[a-zA-Z0-9]+', line)
+        self.required_words = words     # Contained by any matching line
+        words = [re.escape(w) for w in words] # Split the filter into words
         boundary = '[\\s\\.\\-\\\\_]+'   # Word boundary characters
         patterns += [
             # Prefixes match for each word in the command (strongest, these will be the
@@ -53,73 +833,54 @@ class CommandHistory:
 
             # Exact string match
             '(' + re.escape(line) + ')',
-
-            # Substring match in different words
-            boundary.join(['(' + word + ').*' for word in words]),
-
-            # Substring match anywhere (weakest, these will be the last results)
-            ''.join(['(' + word + ').*' for word in words])
         ]
 
         if len(words) <= 1:
             # Optimization: Skip the advanced word-based matching for empty or
             # simple (one-word) filters -- this saves a lot of computation effort
             # as these filters will yield a long list of matched lines!
-            patterns = [patterns[4]]
+            self.patterns = [re.compile(patterns[4], re.IGNORECASE)]
+            self.required_words = [line]
+            return
 
-        # Traverse the history and build the filtered list
-        self.filtered_list = []
-        for pattern in patterns:
-            #print '\n\n', pattern, '\n\n'
-            for line in reversed(self.list):
-                if line in [l for (l, p) in self.filtered_list]:
-                    # We already added this line, skip
-                    continue
-                # No need to re.compile() this, the re library automatically caches compiled
-                # versions of the recently used expressions
-                matches = re.search(pattern, line, re.IGNORECASE)
-                if matches:
-                    self.filtered_list.insert(0, (line, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
-                    #print '\n\n', self.filtered_list[-1], '\n\n'
+        self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
 
-        # We use the trail to navigate back in the same order
-        self.trail = [(self.filter, [(0, len(self.filter))])]
+        # The weakest patterns would be '(word1).*[boundary]+(word2).*...' and
+        # '(word1).*(word2).*...' regexes, which backtrack a lot on long lines;
+        # these find the same spans in linear time
+        self.fuzzy_tier = len(self.patterns)
+        self.patterns += [
+            # Substring match in different words
+            WordsPattern(self.required_words, ' \t\n\r\f\v.-\\_'),
 
-    def up(self):
-        """
-        Navigate back in the command history
-        """
-        if self.filtered_list:
-            self.trail.append(self.filtered_list.pop())
-            return True
-        else:
-            return False
+            # Substring match anywhere (weakest, these will be the last results)
+            WordsPattern(self.required_words)
+        ]
 
-    def down(self):
+    def classify(self, line):
+        """Return the index of the strongest pattern matching a line (or None)"""
+        for tier in range(len(self.patterns)):
+            if self.patterns[tier].search(line):
+                return tier
+        return None
+
+    def order(self, lines, tier):
         """
-        Navigate forward in the command history
+        Order the lines (newest first) matching a pattern: the matches of the
+        weakest patterns can be scattered anywhere in the line, so the ones
+        where the highlighted filter words start words or are close to each
+        other come first (see alignment_score()); ties stay newest first
         """
-        if self.trail:
-            self.filtered_list.append(self.trail.pop())
-            return True
-        else:
-            return False
+        if self.fuzzy_tier is None or tier < self.fuzzy_tier:
+            return lines
+        return sorted(lines, key=lambda line: -alignment_score(line, self.spans(line, tier)))
 
-    def reset(self):
-        """Reset browsing through the history"""
-        self.filter = ''
-        self.filtered_list = []
-        self.trail = []
+    def spans(self, line, tier):
+        """Return the spans of the filter words matched by a pattern"""
+        matches = self.patterns[tier].search(line)
+        return [matches.span(i) for i in range(1, matches.lastindex + 1)]
 
-    def add(self, line):
-        """Add a new line to the history"""
-        if line:
-            #print 'Adding "' + line + '"'
-            if line in self.list:
-                self.list.remove(line)
-            self.list.append(line)
-            self.reset()
 
-    def current(self):
-        """Return the current history item"""
-        return self.trail[-1] if self.trail else ('', [])
\ No newline at end of file
+def trigrams(string):
+    """Return the set of 3-character substrings of a string"""
+    return set([string[i : i + 3] for i in range(len(string) - 2)])
@@ -0,0 +1,400 @@
+#
+# Reading and writing history files
+#
+# Text history files are journals with one line per record: a line is moved to
+# the end of the history by appending it again, so only the last occurrence of
+# each line counts.
+#
+# Records of the command history can also hold what we know about the command,
+# separated from the line by record_separator characters (see format_record()):
+#
+#    <line> RS <cwd> RS <exit code> RS <duration> RS <start time> [RS <uses>]
+#
+# Binary history files hold a snapshot of a history (records of unique lines,
+# oldest first):
+#
+#    'PyCmdHS\x01'                       magic string
+#    <count>                             number of records
+#    <length><UTF-8 bytes> ...           length-prefixed records
+#    <offset> ...                        offset table: file offset of each line
+#
+# where all numbers are unsigned 32-bit little endian integers. They are opened
+# with mmap and the lines are only decoded when accessed, so that a large
+# history can be opened without reading it entirely.
+#
+# Lines dropped from a history file when it is compacted can be kept in archive
+# segments (see HistoryArchive), which are binary history files as well.
+#
+# This module can also be run as a converter between the two formats:
+#
+#    python HistoryStore.py import <text file> <binary file>
+#    python HistoryStore.py export <binary file> <text file>
+#
+import os, re, sys, codecs, mmap, struct, time
+
+try:
+    from msvcrt import locking, LK_NBLCK, LK_UNLCK
+except ImportError:
+    # Not on Windows, use POSIX record locks
+    from fcntl import lockf as _lockf, LOCK_EX, LOCK_NB, LOCK_UN
+    LK_NBLCK = LOCK_EX | LOCK_NB
+    LK_UNLCK = LOCK_UN
+    def locking(fd, mode, nbytes):
+        _lockf(fd, mode, nbytes)
+
+store_magic = 'PyCmdHS\x01'
+store_header = struct.Struct('<8sI')
+store_int = struct.Struct('<I')
+record_separator = u'\x1e'
+
+# Records are added to the newest archive segment until it holds this many
+archive_segment_size = 50000
+
+class HistoryStore:
+    """
+    Read-only, lazily decoded sequence of the lines in a binary history file
+    """
+    def __init__(self, filename):
+        """Open (and map) a binary history file"""
+        self.file = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+            (magic, self.count) = store_header.unpack_from(self.data)
+            self.table = len(self.data) - self.count * store_int.size
+            if magic != store_magic or self.table < store_header.size:
+                raise ValueError('Not a PyCmd history file: ' + filename)
+        except:
+            self.file.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Decode the line at the given index"""
+        return self.record(index).split(record_separator, 1)[0]
+
+    def entry(self, index):
+        """
+        Return the line at the given index, what is known about the command
+        (or None) and how many times it was run (see parse_record())
+        """
+        (line, info, uses) = parse_record(self.record(index))
+        if info is not None and uses is None:
+            uses = 1
+        return (line, info, uses)
+
+    def info(self, index):
+        """Return what is known about the command at the given index (or None)"""
+        return parse_record(self.record(index))[1]
+
+    def uses(self, index):
+        """Return how many times the command at the given index was run"""
+        uses = self.entry(index)[2]
+        return uses if uses is not None else 0
+
+    def record(self, index):
+        """Decode the record at the given index"""
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('history index out of range')
+        offset = self.offset(index)
+        length = store_int.unpack_from(self.data, offset)[0]
+        offset += store_int.size
+        return self.data[offset : offset + length].decode('utf8', 'replace')
+
+    def offset(self, index):
+        """Return the file offset of the record at the given index"""
+        return store_int.unpack_from(self.data, self.table + index * store_int.size)[0]
+
+    def find(self, line):
+        """
+        Return the index of a line (or None if it is not there) without
+        decoding the other lines: the records starting with the line are
+        searched for in the mapped file, then looked up in the offset table
+        """
+        encoded = line.encode('utf8') if isinstance(line, unicode) else line
+        # A record holding the line only, or starting with it as first field
+        for (needle, start) in [(store_int.pack(len(encoded)) + encoded, 0),
+                                (encoded + record_separator.encode('utf8'), store_int.size)]:
+            pos = self.data.find(needle, store_header.size)
+            while 0 <= pos < self.table:
+                offset = pos - start
+                if offset >= store_header.size:
+                    length = store_int.unpack_from(self.data, offset)[0]
+                    # Inside another record, these are (mostly) text bytes
+                    # that make no sense as a length
+                    if length >= len(encoded) and offset + store_int.size + length <= self.table:
+                        index = self.index_at(offset)
+                        if index is not None:
+                            return index
+                pos = self.data.find(needle, pos + 1)
+        return None
+
+    def index_at(self, offset):
+        """Return the index of the record at a file offset (or None)"""
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.offset(middle) < offset:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.offset(low) == offset:
+            return low
+        return None
+
+    def close(self):
+        """Unmap and close the history file (if still open)"""
+        if not self.file.closed:
+            self.data.close()
+            self.file.close()
+
+
+def format_record(line, info = None, uses = None):
+    """
+    Format a history record for a line and what we know about the command, as
+    a (cwd, exit code, duration, start time) tuple, and how many times it was
+    run (see CommandHistory.set_info())
+    """
+    if info is None:
+        return line
+    (cwd, exit_code, duration, start_time) = info
+    fields = [line, cwd, u'%d' % exit_code, u'%.3f' % duration, u'%.3f' % start_time]
+    if uses is not None:
+        fields.append(u'%.4f' % uses)
+    return record_separator.join(fields)
+
+
+def parse_record(record):
+    """
+    Return the line, what we know about the command (or None) and how many
+    times it was run (or None) from a record
+    """
+    fields = record.split(record_separator)
+    if len(fields) in [5, 6]:
+        try:
+            info = (fields[1], int(fields[2]), float(fields[3]), float(fields[4]))
+            uses = float(fields[5]) if len(fields) == 6 else None
+            return (fields[0], info, uses)
+        except ValueError:
+            pass
+    return (fields[0], None, None)
+
+
+class HistoryArchive:
+    """
+    The archive of a history file: the records dropped from it, in segments
+    named filename + '.<n>.bin' (the higher n, the newer the records)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def segment_files(self):
+        """Return the (number, file name) pairs of the segments, newest first"""
+        (directory, name) = os.path.split(self.filename)
+        pattern = re.compile(re.escape(name) + r'\.([0-9]+)\.bin$')
+        try:
+            names = os.listdir(directory or os.curdir)
+        except OSError:
+            return []
+        segments = []
+        for segment in names:
+            match = pattern.match(segment)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(directory, segment)))
+        segments.sort(reverse = True)
+        return segments
+
+    def segments(self):
+        """
+        Open the segments one at a time, newest first; each is closed when
+        moving on to the next one
+        """
+        for (number, segment) in self.segment_files():
+            try:
+                store = HistoryStore(segment)
+            except (IOError, ValueError), e:
+                # Being written, or damaged
+                continue
+            try:
+                yield store
+            finally:
+                store.close()
+
+    def add(self, records):
+        """
+        Archive records (oldest first); if the newest segment is small enough,
+        it is replaced with a new one holding its records plus these
+        """
+        if not records:
+            return
+        segments = self.segment_files()
+        number = segments[0][0] + 1 if segments else 1
+        merged = None
+        if segments:
+            try:
+                store = HistoryStore(segments[0][1])
+                if len(store) + len(records) <= archive_segment_size:
+                    records = [store.record(i) for i in xrange(len(store))] + records
+                    merged = segments[0][1]
+                store.close()
+            except (IOError, ValueError), e:
+                pass
+        # Written under another name first, so that nobody opens it half-written
+        segment = self.filename + '.%d.bin' % number
+        write_history_store(segment + '.tmp', replay_history(records))
+        os.rename(segment + '.tmp', segment)
+        if merged:
+            try:
+                os.remove(merged)
+            except OSError:
+                # Still open elsewhere; the duplicate records are harmless
+                pass
+
+
+def write_history_store(filename, records):
+    """Write a binary history file holding the given records (of unique lines)"""
+    store_file = open(filename, 'wb')
+    store_file.write(store_header.pack(store_magic, len(records)))
+    offsets = []
+    offset = store_header.size
+    for record in records:
+        record = record.encode('utf8')
+        store_file.write(store_int.pack(len(record)) + record)
+        offsets.append(offset)
+        offset += store_int.size + len(record)
+    store_file.write(''.join([store_int.pack(o) for o in offsets]))
+    store_file.close()
+
+
+class HistoryLock:
+    """
+    Lock shared by all the PyCmd processes using a history file, to be held
+    while reading or writing it; this locks the first byte of filename + '.lock'
+    """
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+        self.file = None
+
+    def acquire(self, timeout = None):
+        """
+        Wait for the lock (at most timeout seconds, if specified); return
+        whether it was acquired
+        """
+        self.file = open(self.filename, 'ab')
+        self.file.seek(0)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                locking(self.file.fileno(), LK_NBLCK, 1)
+                return True
+            except IOError:
+                if timeout is not None and time.time() >= deadline:
+                    # Held by a hung process, most likely
+                    self.file.close()
+                    self.file = None
+                    return False
+                time.sleep(0.01)
+
+    def release(self):
+        """Release the lock"""
+        self.file.seek(0)
+        locking(self.file.fileno(), LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+
+def read_history_records(filename):
+    """
+    Read all the lines written to a text history file, including duplicates
+    """
+    return read_history_tail(filename)[0]
+
+
+def read_history_tail(filename, position = None):
+    """
+    Read the lines appended to a text history file since the given position,
+    as returned by a previous call (or the entire file if no position is
+    given); return them together with the new position.
+
+    If the file was rewritten (i.e. compacted) since the given position was
+    returned, None is returned instead of the lines and the file should be read
+    entirely again.
+    """
+    if not os.path.isfile(filename):
+        return ([], (0, ''))
+    history_file = open(filename, 'rb')
+    try:
+        if position is None:
+            data = history_file.read()
+            (offset, check) = (0, '')
+        else:
+            # The position is an offset and the bytes just before it, which
+            # are different (or gone) if the file was rewritten
+            (offset, check) = position
+            history_file.seek(0, 2)
+            if history_file.tell() < offset:
+                return (None, position)
+            history_file.seek(offset - len(check))
+            if history_file.read(len(check)) != check:
+                return (None, position)
+            data = history_file.read()
+            # Only take complete lines (another process might be writing)
+            data = data[:data.rfind('\n') + 1]
+    finally:
+        history_file.close()
+
+    lines = data.split('\n')
+    if lines[-1] == '':
+        del lines[-1]
+    records = [line.rstrip('\r').decode('utf8', 'replace') for line in lines]
+    check = (check + data)[-64:]
+    return (records, (offset + len(data), check))
+
+
+def replay_history(records, length = None):
+    """
+    Compute the history from the records written to a text history file: only
+    the last record of each line is kept, and only the last length records (if
+    specified)
+    """
+    history = []
+    seen = set()
+    for record in reversed(records):
+        if length is not None and len(history) >= length:
+            break
+        line = record.split(record_separator, 1)[0]
+        if not line in seen:
+            seen.add(line)
+            history.append(record)
+    history.reverse()
+    return history
+
+
+def import_history(text_filename, store_filename):
+    """Convert a text history file to a binary one"""
+    write_history_store(store_filename, replay_history(read_history_records(text_filename)))
+
+
+def export_history(store_filename, text_filename):
+    """Convert a binary history file to a text one"""
+    store = HistoryStore(store_filename)
+    history_file = codecs.open(text_filename, 'w', 'utf8')
+    for i in xrange(len(store)):
+        history_file.write(store.record(i) + u'\n')
+    history_file.close()
+    store.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'import':
+        import_history(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'export':
+        export_history(sys.argv[2], sys.argv[3])
+    else:
+        print 'Usage:'
+        print '\t python HistoryStore.py import <text file> <binary file>'
+        print '\t python HistoryStore.py export <binary file> <text file>'
@@ -0,0 +1,135 @@
+import sys, threading, Queue
+
+class HistoryWriter:
+    """
+    Write history updates to disk from a background thread, so that a slow
+    (e.g. network-redirected) disk never blocks the prompt.
+
+    Updates are queued as (line, filename, length) tuples; the thread takes
+    all the updates queued so far and writes them with a single call of the
+    write function per file, which receives the (de-duplicated) list of lines
+    to append.
+
+    When writing a file fails (IOError or OSError, e.g. a locked or full
+    disk), the error is reported once on stderr and the lines are kept for the
+    next burst. Lines that can't be written at all (e.g. can't be encoded) are
+    reported and dropped.
+
+    The lines that may not be in the files yet can be listed with unwritten().
+    """
+    def __init__(self, write):
+        """Create the writer and start its thread"""
+        self.write = write
+        self.queue = Queue.Queue()
+        # The lines that could not be written yet, per file, and those being
+        # written again by the current burst
+        self.pending = {}
+        self.retried = {}
+        # The (line, filename) updates queued or being written
+        self.queued = []
+        self.lock = threading.Lock()
+        # The files whose last write failed (and was reported)
+        self.failed = set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, line, filename, length):
+        """Queue a line to be written to a history file"""
+        self.lock.acquire()
+        try:
+            self.queued.append((line, filename))
+        finally:
+            self.lock.release()
+        self.queue.put((line, filename, length))
+
+    def unwritten(self, filename):
+        """
+        Return the lines queued for a file, or waiting to be written again, in
+        the order they were queued; they may not be in the file yet
+        """
+        self.lock.acquire()
+        try:
+            lines = []
+            for pending in [self.retried, self.pending]:
+                if filename in pending:
+                    lines.extend(pending[filename][1])
+            lines.extend([line for (line, f) in self.queued if f == filename])
+        finally:
+            self.lock.release()
+        return lines
+
+    def flush(self):
+        """Wait until all the queued updates are written (or tried again)"""
+        self.queue.join()
+        if self.pending:
+            # An empty update starts one more burst
+            self.queue.put(None)
+            self.queue.join()
+
+    def run(self):
+        """Thread loop: write the queued updates in bursts"""
+        while True:
+            updates = [self.queue.get()]
+            try:
+                while True:
+                    updates.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            # Group the lines per file, after those of the failed writes; when
+            # a line is written several times, only the last one counts
+            files = []
+            lines = {}
+            self.lock.acquire()
+            try:
+                (self.retried, self.pending) = (self.pending, {})
+            finally:
+                self.lock.release()
+            for (filename, (length, pending_lines)) in self.retried.items():
+                files.append((filename, length))
+                lines[filename] = list(pending_lines)
+            for (line, filename, length) in filter(None, updates):
+                if not filename in lines:
+                    files.append((filename, length))
+                    lines[filename] = []
+                elif line in lines[filename]:
+                    lines[filename].remove(line)
+                lines[filename].append(line)
+
+            for (filename, length) in files:
+                self.write_lines(lines[filename], filename, length)
+            self.lock.acquire()
+            try:
+                self.retried = {}
+                for update in filter(None, updates):
+                    self.queued.remove(update[:2])
+            finally:
+                self.lock.release()
+            for update in updates:
+                self.queue.task_done()
+
+    def write_lines(self, lines, filename, length):
+        """Write lines to a file, keeping them for the next burst if it fails"""
+        try:
+            self.write(lines, filename, length)
+            self.failed.discard(filename)
+        except (IOError, OSError), e:
+            # The lines are written next time
+            self.lock.acquire()
+            try:
+                self.pending.setdefault(filename, (length, []))[1].extend(lines)
+            finally:
+                self.lock.release()
+            if not filename in self.failed:
+                self.failed.add(filename)
+                sys.stderr.write('PyCmd: can\'t write ' + filename + ': ' + str(e) + '\n')
+        except Exception, e:
+            # Not much we can do about a bad line, but keep the others: write
+            # them one at a time
+            if len(lines) > 1:
+                for line in lines:
+                    self.write_lines([line], filename, length)
+            else:
+                sys.stderr.write('PyCmd: dropped history line ' + repr(lines[0])
+                                 + ' (' + filename + '): ' + str(e) + '\n')
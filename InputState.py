@@ -39,6 +39,7 @@ class ActionCode:
     ACTION_SEARCH_LEFT = 26
     ACTION_SELECT_UP = 27
     ACTION_SELECT_DOWN = 28
+    ACTION_HISTORY_REFRESH = 29
 
 
 class InputState:
@@ -126,7 +127,8 @@ class InputState:
             ActionCode.ACTION_REDO: self.key_redo,
             ActionCode.ACTION_UNDO_EMACS: self.key_undo_emacs,
             ActionCode.ACTION_EXPAND: self.key_expand,
-            ActionCode.ACTION_TOGGLE_OVERWRITE: self.key_toggle_overwrite, }
+            ActionCode.ACTION_TOGGLE_OVERWRITE: self.key_toggle_overwrite,
+            ActionCode.ACTION_HISTORY_REFRESH: self.key_history_refresh, }
 
         # Action categories
         self.insert_actions = [ActionCode.ACTION_INSERT,
@@ -414,7 +416,8 @@ class InputState:
         if not self.history.trail:
             # Start search
             self.history.start(self.before_cursor + self.after_cursor)
-        if not self.history.up():
+        if self.history.up() is False:
+            # No more matches (None means that the search is still running)
             self.bell = True
         self.before_cursor = self.history.current()[0]
         self.after_cursor = ''
@@ -424,6 +427,22 @@ class InputState:
 
         self.reset_selection()
 
+    def key_history_refresh(self):
+        """Show the match of the history search that we were waiting for"""
+        found = self.history.refresh()
+        if found is None:
+            return
+
+        # Clear undo/redo history
+        self.undo = []
+        self.redo = []
+
+        if not found:
+            self.bell = True
+        self.before_cursor = self.history.current()[0]
+        self.after_cursor = ''
+        self.reset_selection()
+
     def key_down(self):
         """Arrow down (history next)"""
 
@@ -582,7 +601,7 @@ class InputState:
 
             context_matches = []
             no_context_matches = []
-            for line in reversed(self.history.list):
+            for line in self.history.newest_first():
                 line_words = [''] + line.split(' ')
                 for i in range(len(line_words) - 1, 0, -1):
                     word = line_words[i]
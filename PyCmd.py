@@ -1,13 +1,19 @@
-import sys, os, tempfile, signal, time, traceback, codecs
+import sys, os, re, tempfile, signal, time, traceback, codecs, threading
 import win32console, win32gui, win32con
 
 from codeutil import patchable, hijack
 from common import parse_line, unescape, sep_tokens, sep_chars, exec_extensions, pseudo_vars
+from common import completion_tokenizer
 from common import expand_tilde, expand_env_vars
 from common import associated_application, full_executable_path, is_gui_application
 from completion import complete_file, complete_wildcard, complete_env_var, find_common_prefix, has_wildcards, wildcard_to_regex
+from dirlisting import directory_cache, path_index
 from InputState import ActionCode, InputState
 from DirHistory import DirHistory
+from HistoryWriter import HistoryWriter
+from HistoryStore import HistoryStore, HistoryLock, HistoryArchive, write_history_store
+from HistoryStore import read_history_records, read_history_tail, replay_history
+from HistoryStore import format_record, parse_record
 import console
 from sys import stdout, stderr
 from console import move_cursor, get_cursor, cursor_backward, set_cursor_attributes
@@ -23,8 +29,35 @@ pycmd_install_dir = None
 state = None
 dir_hist = None
 tmpfile = None
+history_writer = None
+history_archive = None
 save_history_limit = 2000
 
+# Binary history snapshots (see HistoryStore.py) are meant for much larger
+# histories: compact_history() keeps this many lines in them instead
+save_history_store_limit = 1000000
+
+# Number of records in each history file, and the position up to which it
+# was read by this process
+history_records = {}
+history_positions = {}
+history_lock = threading.Lock()
+
+# The records appended to each history file by this process since it was last
+# read, which merge_history() skips
+history_appends = {}
+
+# How long to wait for the history locks (in seconds) before giving up, e.g.
+# because another PyCmd window hangs while holding them; the prompt only waits
+# briefly before a history search, and skips picking up the other windows'
+# commands if it can't get them
+history_lock_timeout = 5.0
+history_merge_lock_timeout = 0.05
+
+# Virtual key code (unassigned) of the synthetic keyboard event that wakes up
+# the main loop when the background history search finds what it waited for
+history_search_key = 0xE8
+
 @patchable
 def init():
     # %APPDATA% is not always defined (e.g. when using runas.exe)
@@ -49,16 +82,26 @@ def init():
     global state
     state = InputState()
 
-    # Read/initialize command history
-    state.history.list = read_history(pycmd_data_dir + '\\history')
+    # Read/initialize command history; the lines dropped from it are archived
+    if not load_history(state.history, pycmd_data_dir + '\\history'):
+        print 'Warning: Can\'t lock history!'
+    global history_archive
+    history_archive = HistoryArchive(pycmd_data_dir + '\\history')
 
     # Read/initialize directory history
     global dir_hist
     dir_hist = DirHistory()
-    dir_hist.locations = read_history(pycmd_data_dir + '\\dir_history')
+    dir_hist.locations = read_history(pycmd_data_dir + '\\dir_history', dir_hist.max_len)
+    if dir_hist.locations is None:
+        print 'Warning: Can\'t lock dir_history!'
+        dir_hist.locations = []
     dir_hist.index = len(dir_hist.locations) - 1
     dir_hist.visit_cwd()
 
+    # Start the thread that writes the history files
+    global history_writer
+    history_writer = HistoryWriter(write_history)
+
     # Create temporary file
     global tmpfile
     (handle, tmpfile) = tempfile.mkstemp(dir = pycmd_data_dir + '\\tmp')
@@ -69,6 +112,7 @@ def init():
 
 @patchable
 def deinit():
+    history_writer.flush()
     os.remove(tmpfile)
 
 def main():
@@ -125,6 +169,9 @@ def main():
             internal_exit()
         arg += 1
 
+    directory_cache.ttl = behavior.completion_cache_ttl
+    path_index.ttl = behavior.completion_cache_ttl
+
     hijack('motd', color, appearance, behavior)
     if not behavior.quiet_mode:
         # Print some splash text
@@ -242,9 +289,7 @@ def main():
                         scrolling = False
                     else:
                         state.handle(ActionCode.ACTION_ESCAPE)
-                        update_history(state.history.list[-1],
-                                     pycmd_data_dir + '\\history',
-                                       save_history_limit)
+                        update_command_history()
                         auto_select = False
                 elif rec.VirtualKeyCode == 65:          # Ctrl-A
                     state.handle(ActionCode.ACTION_HOME, select)
@@ -255,6 +300,7 @@ def main():
                 elif rec.VirtualKeyCode == 70:          # Ctrl-F
                     state.handle(ActionCode.ACTION_RIGHT, select)
                 elif rec.VirtualKeyCode == 80:          # Ctrl-P
+                    prepare_history_search()
                     state.handle(ActionCode.ACTION_PREV)
                 elif rec.VirtualKeyCode == 78:          # Ctrl-N
                     state.handle(ActionCode.ACTION_NEXT)
@@ -327,6 +373,7 @@ def main():
                 elif rec.VirtualKeyCode == 70:          # Alt-F
                     state.handle(ActionCode.ACTION_RIGHT_WORD, select)
                 elif rec.VirtualKeyCode == 80:          # Alt-P
+                    prepare_history_search()
                     state.handle(ActionCode.ACTION_PREV)
                 elif rec.VirtualKeyCode == 78:          # Alt-N
                     state.handle(ActionCode.ACTION_NEXT)
@@ -374,6 +421,7 @@ def main():
                     elif rec.VirtualKeyCode == 35:      # End
                         state.handle(ActionCode.ACTION_END, select)
                     elif rec.VirtualKeyCode == 38:      # Up arrow
+                        prepare_history_search()
                         state.handle(ActionCode.ACTION_PREV)
                     elif rec.VirtualKeyCode == 40:      # Down arrow
                         state.handle(ActionCode.ACTION_NEXT)
@@ -383,6 +431,8 @@ def main():
                         state.handle(ActionCode.ACTION_TOGGLE_OVERWRITE)
                     elif rec.VirtualKeyCode == 114:     # F3:
                         state.handle(ActionCode.ACTION_SEARCH_RIGHT)
+                    elif rec.VirtualKeyCode == history_search_key:
+                        state.handle(ActionCode.ACTION_HISTORY_REFRESH)
 
 
                 elif rec.Char == chr(13):               # Enter
@@ -397,14 +447,16 @@ def main():
                         scrolling = False
                     else:
                         state.handle(ActionCode.ACTION_ESCAPE)
-                        update_history(state.history.list[-1],
-                                     pycmd_data_dir + '\\history',
-                                       save_history_limit)
+                        update_command_history()
                         auto_select = False
                 elif rec.Char == '\t':                  # Tab
-                    tokens = parse_line(state.before_cursor)
-                    if tokens == [] or state.before_cursor[-1] in sep_chars:
-                        tokens.append('')   # This saves some checks later on
+                    spans = completion_tokenizer.tokenize(state.before_cursor)[0]
+                    if spans == [] or state.before_cursor[-1] in sep_chars:
+                        tokens = ['']   # This saves some checks later on
+                    else:
+                        # Only the last token is needed
+                        (kind, start, end) = spans[-1]
+                        tokens = [state.before_cursor[start : end]]
                     if tokens[-1].strip('"').count('%') % 2 == 1:
                         (completed, suggestions) = complete_env_var(state.before_cursor)
                     elif has_wildcards(tokens[-1]):
@@ -509,13 +561,14 @@ def main():
             print
             if not is_pure_cd(tokens):
                 dir_hist.keep = True
+            cwd = os.getcwd().decode(sys.getfilesystemencoding())
+            start_time = time.time()
             run_command(tokens)
+            info = (cwd, command_exit_code(), time.time() - start_time, start_time)
 
         # Add to history
-        state.history.add(line)
-        update_history(state.history.list[-1],
-                     pycmd_data_dir + '\\history',
-                       save_history_limit)
+        state.history.add(line, info)
+        update_command_history()
 
 
         # Add to dir history
@@ -640,9 +693,16 @@ def run_in_cmd(tokens):
     if line_sanitized != '':
         command = u'"'
         command += line_sanitized
-        command += u' &set > "' + tmpfile + u'"'
+        # %ERRORLEVEL% would be expanded with the rest of the line, i.e. before
+        # the command runs; with CALL (and the caret hiding it from the first
+        # expansion), it is expanded when the echo runs, right after the
+        # command (the pseudo-variables are not in the environment, see
+        # run_command(), so this is the actual exit code)
+        command += u' & call echo ERRORLEVEL=%^ERRORLEVEL% > "' + tmpfile + u'"'
+        command += u' &set >> "' + tmpfile + u'"'
         for var in pseudo_vars:
-            command += u' & echo ' + var + u'="%' + var + u'%" >> "' + tmpfile + '"'
+            if var != 'ERRORLEVEL':
+                command += u' & echo ' + var + u'="%' + var + u'%" >> "' + tmpfile + '"'
         command += u'& <nul (set /p xxx=CD=) >>"' + tmpfile + u'" & cd >>"' + tmpfile + '"'
         command += u'"'
         os.system(command.encode(sys.getfilesystemencoding()))
@@ -678,48 +738,348 @@ def signal_handler(signum, frame):
         write_input(67, 0x0008)
 
 
+def command_exit_code():
+    """
+    Return the exit code of the last command, i.e. its ERRORLEVEL (commands
+    we run internally, e.g. a simple CD, don't set it and count as successful)
+    """
+    try:
+        return int(os.environ.get('ERRORLEVEL', '0'))
+    except ValueError:
+        return 0
+
+
+def update_command_history():
+    """Write the line last added to the command history to the history file"""
+    line = state.history.last()
+    if line is None:
+        # Nothing was added yet
+        return
+    update_history(format_record(line, state.history.last_info(),
+                                 state.history.last_uses()),
+                   pycmd_data_dir + '\\history',
+                   save_history_limit)
+
+
 def update_history(line, filename, length):
     """
     Append a new line to a history file. If the line was already present in the
-    file, we move it to the end. The resulting file is then truncated to the 
-    specified number of lines.
+    file, it is moved to the end. The file is limited to the specified number
+    of lines.
 
+    The update is queued and written in the background by write_history().
     """
-    if os.path.isfile(filename):
-        # Read previously saved history and merge with current
-        history_file = codecs.open(filename, 'r', 'utf8', 'replace')
-        history_to_save = [l.rstrip(u'\n') for l in history_file.readlines()]
+    history_writer.update(line, filename, length)
+
+
+def write_history(lines, filename, length):
+    """
+    Append lines to a history file. The file is a journal: if a line was
+    already present, the older record is kept until the file is compacted, but
+    read_history() only keeps the last occurrence of each line (i.e. the line
+    is moved to the end). Once the file holds twice the specified number of
+    lines, it is compacted.
+
+    For binary histories, the lines are appended to the log of the lines added
+    since the snapshot (see history_journal()).
+    """
+    journal = history_journal(filename)
+    lock = lock_history(filename)
+    if lock is None:
+        raise IOError('Timed out waiting for the lock of ' + os.path.basename(filename))
+    try:
+        if not journal in history_records:
+            history_records[journal] = len(read_history_records(journal))
+        history_file = codecs.open(journal, 'a', 'utf8')
+        history_file.writelines([l + u'\n' for l in lines])
         history_file.close()
-        if line in history_to_save:
-            history_to_save.remove(line)
-        history_to_save.append(line)
-    else:
-        # No previous history, save current
-        history_to_save = [line]
+        history_records[journal] += len(lines)
+        history_appends.setdefault(journal, []).extend(lines)
+    finally:
+        unlock_history(lock)
+
+    if history_records[journal] > 2 * length:
+        compact_history(filename, length)
 
-    if len(history_to_save) > length:
-        history_to_save = history_to_save[-length :]    # Limit history file
 
-    # Write merged history to history file
-    history_file = codecs.open(filename, 'w', 'utf8')
-    history_file.writelines([l + u'\n' for l in history_to_save])
-    history_file.close()
+def compact_history(filename, length):
+    """
+    Rewrite a history file without the duplicate lines, truncated to the
+    specified number of lines; for the command history, the dropped lines are
+    moved to the archive (if enabled)
+
+    For binary histories, the log is folded into a new snapshot, which is only
+    truncated to save_history_store_limit lines; as the current snapshot can't
+    be replaced while it is open, the new one is written next to it (under a
+    new name, so that no snapshot mapped by a PyCmd window is ever overwritten)
+    and moved in place by open_history_store().
+    """
+    lock = lock_history(filename)
+    if lock is None:
+        # The file is still too long, this is tried again after the next write
+        return
+    try:
+        journal = history_journal(filename)
+        records = read_history_records(journal)
+        if journal != filename:
+            snapshots = new_snapshots(filename)
+            if snapshots:
+                snapshot = snapshots[0][1]
+            else:
+                snapshot = filename + '.bin'
+            store = HistoryStore(snapshot)
+            records = [store.record(i) for i in xrange(len(store))] + records
+            store.close()
+            length = max(length, save_history_store_limit)
+        history_to_save = replay_history(records)
+        if (behavior.history_archive and history_archive is not None
+            and filename == history_archive.filename):
+            history_archive.add(history_to_save[:-length])
+        history_to_save = history_to_save[-length:]
+        if journal != filename:
+            # Written under another name first, so that nobody opens it
+            # half-written
+            snapshot = filename + '.bin.new.%d' % (snapshots[0][0] + 1 if snapshots else 1)
+            write_history_store(snapshot + '.tmp', history_to_save)
+            os.rename(snapshot + '.tmp', snapshot)
+            history_to_save = []
+        history_file = codecs.open(journal, 'w', 'utf8')
+        history_file.writelines([l + u'\n' for l in history_to_save])
+        history_file.close()
+        history_records[journal] = len(history_to_save)
+        history_appends[journal] = []
+    finally:
+        unlock_history(lock)
 
 
-def read_history(filename):
+def read_history(filename, length = None, timeout = history_lock_timeout):
     """
-    Read and return a list of lines from a history file
+    Read and return a list of lines from a history file (at most length lines,
+    if specified); return None if the file could not be locked within timeout
+    seconds
     """
     if os.path.isfile(filename):
-        history_file = codecs.open(filename, 'r', 'utf8', 'replace')
-        history = [line.rstrip(u'\n\r') for line in history_file.readlines()]
-        history_file.close()
+        lock = lock_history(filename, timeout)
+        if lock is None:
+            return None
+        try:
+            (records, history_positions[filename]) = read_history_tail(filename)
+            history_records[filename] = len(records)
+            history_appends[filename] = []
+        finally:
+            unlock_history(lock)
+        history = replay_history(records, length)
     else:
         print 'Warning: Can\'t open ' + os.path.basename(filename) + '!'
         history = []
     return history
 
 
+def load_history(history, filename, timeout = history_lock_timeout):
+    """
+    Load a history file into a CommandHistory (replacing its contents); all the
+    lines written since the last compaction are loaded, so that none of them
+    is missing from both the history and the archive
+
+    Return False (leaving the CommandHistory as is) if the file could not be
+    locked within timeout seconds.
+    """
+    journal = history_journal(filename)
+    if journal == filename:
+        lines = read_history(filename, timeout = timeout)
+        if lines is None:
+            return False
+        records = [parse_record(r) for r in lines]
+        history.load([line for (line, info, uses) in records],
+                     [info for (line, info, uses) in records],
+                     [uses for (line, info, uses) in records])
+    else:
+        # Binary history: the snapshot is only read when needed, the lines
+        # added since are replayed on top of it
+        lock = lock_history(filename, timeout)
+        if lock is None:
+            return False
+        try:
+            store = open_history_store(filename)
+            (records, history_positions[journal]) = read_history_tail(journal)
+            history_records[journal] = len(records)
+            history_appends[journal] = []
+        finally:
+            unlock_history(lock)
+        previous = history.store
+        history.load(store)
+        for record in records:
+            history.add(*parse_record(record))
+        if isinstance(previous, HistoryStore):
+            previous.close()
+    return True
+
+
+def prepare_history_search():
+    """
+    Get the command history ready for a new search (i.e. when not already
+    navigating it): pick up the commands run in other PyCmd windows and apply
+    the history settings
+    """
+    if state.history.trail:
+        return
+    if behavior.shared_history:
+        merge_history()
+    cwd = os.getcwd().decode(sys.getfilesystemencoding())
+    if behavior.history_filter == 'directory':
+        state.history.only_cwd = cwd
+    else:
+        state.history.only_cwd = None
+    state.history.only_successful = behavior.history_filter == 'successful'
+    state.history.ranking = behavior.history_ranking
+    state.history.archive = history_archive if behavior.history_archive else None
+    if behavior.history_directory_first:
+        state.history.first_cwd = cwd
+    else:
+        state.history.first_cwd = None
+    if behavior.history_search_budget > 0:
+        state.history.search_budget = behavior.history_search_budget / 1000.0
+    else:
+        state.history.search_budget = None
+    state.history.notify = notify_history_search
+
+
+def notify_history_search():
+    """
+    Wake up the main loop (called by the background history search when it
+    finds what we were waiting for)
+    """
+    write_input(history_search_key, 0)
+
+
+def merge_history():
+    """
+    Add the commands recorded in the history file by other PyCmd windows since
+    we last read it (the records appended by this window are skipped)
+    """
+    filename = pycmd_data_dir + '\\history'
+    journal = history_journal(filename)
+    lock = lock_history(filename, history_merge_lock_timeout)
+    if lock is None:
+        # Don't keep the prompt waiting, try again before the next search
+        return
+    try:
+        (records, position) = read_history_tail(journal, history_positions.get(journal))
+        if records is not None:
+            history_positions[journal] = position
+            # All the records appended by this window are read by now
+            appended = history_appends.pop(journal, [])
+            others = []
+            for record in records:
+                if record in appended:
+                    appended.remove(record)
+                else:
+                    others.append(record)
+    finally:
+        unlock_history(lock)
+    if records is None:
+        # The file was compacted in the meantime, read it again; the lines of
+        # this window that are not written yet are added back on top of it
+        lines = history_writer.unwritten(filename)
+        if load_history(state.history, filename, history_merge_lock_timeout):
+            for line in lines:
+                state.history.add(*parse_record(line))
+    else:
+        for record in others:
+            state.history.add(*parse_record(record))
+
+
+def history_journal(filename):
+    """
+    Return the file recording the updates of a history: the history file itself
+    or, if there is a binary snapshot of the history (filename + '.bin', see
+    HistoryStore.py), the log of the lines added since the snapshot
+    (filename + '.log')
+    """
+    if os.path.isfile(filename + '.bin') or new_snapshots(filename):
+        return filename + '.log'
+    else:
+        return filename
+
+
+def new_snapshots(filename):
+    """
+    Return the snapshots of a history file written by compact_history() that
+    were not moved in place yet, as (number, file name) pairs, newest first
+    """
+    (directory, name) = os.path.split(filename)
+    pattern = re.compile(re.escape(name) + r'\.bin\.new(?:\.([0-9]+))?$')
+    try:
+        names = os.listdir(directory or os.curdir)
+    except OSError:
+        return []
+    snapshots = []
+    for snapshot in names:
+        match = pattern.match(snapshot)
+        if match:
+            snapshots.append((int(match.group(1) or 0), os.path.join(directory, snapshot)))
+    snapshots.sort(reverse = True)
+    return snapshots
+
+
+def open_history_store(filename):
+    """
+    Open the binary snapshot of a history file, first moving in place the
+    newest snapshot written by compact_history() (unless the current one is
+    still open in another PyCmd window, in which case the newest one is used
+    as is); the older ones are removed once no window has them open
+    """
+    snapshots = new_snapshots(filename)
+    snapshot = filename + '.bin'
+    if snapshots:
+        snapshot = snapshots[0][1]
+        try:
+            if os.path.isfile(filename + '.bin'):
+                os.remove(filename + '.bin')
+            os.rename(snapshot, filename + '.bin')
+            snapshot = filename + '.bin'
+        except OSError:
+            pass
+        for (number, older) in snapshots[1:]:
+            try:
+                os.remove(older)
+            except OSError:
+                # Still open in another window
+                pass
+    return HistoryStore(snapshot)
+
+
+def lock_history(filename, timeout = history_lock_timeout):
+    """
+    Acquire the locks protecting a history file from the other threads and the
+    other PyCmd processes, waiting at most timeout seconds; return the file
+    lock to pass to unlock_history(), or None if they could not be acquired
+    """
+    deadline = time.time() + timeout
+    while not history_lock.acquire(False):
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.01)
+    lock = HistoryLock(filename)
+    try:
+        acquired = lock.acquire(max(deadline - time.time(), 0))
+    except:
+        history_lock.release()
+        raise
+    if not acquired:
+        history_lock.release()
+        return None
+    return lock
+
+
+def unlock_history(lock):
+    """Release the locks acquired by lock_history()"""
+    try:
+        lock.release()
+    finally:
+        history_lock.release()
+
+
 def print_usage():
     """Print usage information"""
     print 'Usage:'
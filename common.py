@@ -1,10 +1,11 @@
 #
 # Common utility functions
 #
-import os, string, fsm, _winreg, pefile, mmap, sys, traceback
+import os, string, fsm, _winreg, pefile, mmap, sys, traceback, copy
 import re
 import pycmd_public
 from codeutil import patchable
+from fuzzy import WordsPattern
 
 
 # Stop points when navigating one word at a time
@@ -33,17 +34,33 @@ exec_extensions = os.environ['PATHEXT'].lower().split(os.pathsep)
 # Pseudo environment variables
 pseudo_vars = ['CD', 'DATE', 'ERRORLEVEL', 'RANDOM', 'TIME']
 
-def parse_line(line):
-    """Tokenize a command line based on whitespace while observing quotes"""
+def accumulate_token(fsm):
+    """Lexer action: add current symbol to last token in list."""
+    fsm.memory[-1] = fsm.memory[-1] + fsm.input_symbol
 
-    def accumulate(fsm):
-        """Action: add current symbol to last token in list."""
-        fsm.memory[-1] = fsm.memory[-1] + fsm.input_symbol
+def start_empty_token(fsm):
+    """Lexer action: start a new token."""
+    if fsm.memory[-1] != '':
+        fsm.memory.append('')
 
-    def start_empty_token(fsm):
-        """Action: start a new token."""
-        if fsm.memory[-1] != '':
-            fsm.memory.append('')
+def accumulate_span(fsm):
+    """Lexer action: extend the last [start, end] token span over current symbol."""
+    span = fsm.memory[-1]
+    if span[0] is None:
+        span[0] = fsm.input_index
+    span[1] = fsm.input_index + 1
+
+def start_empty_span(fsm):
+    """Lexer action: start a new token span."""
+    if fsm.memory[-1][0] is not None:
+        fsm.memory.append([None, None])
+
+def build_line_lexer(accumulate, start_empty_token):
+    """
+    Build the FSM that tokenizes command lines (see parse_line()); its memory
+    is the list of tokens, built by the given actions that add the current
+    symbol to the last token and that start a new token
+    """
 
     def start_token(fsm):
         """Action: start a new token and accumulate."""
@@ -112,12 +129,139 @@ def parse_line(line):
     # seen '^'
     f.add_transition_any('escape', accumulate, 'init')
 
+    f.compile()
+    return f
+
+# Built once; parse_line() and parse_line_spans() run a copy of these
+line_lexer = build_line_lexer(accumulate_token, start_empty_token)
+span_lexer = build_line_lexer(accumulate_span, start_empty_span)
+
+def parse_line(line):
+    """Tokenize a command line based on whitespace while observing quotes"""
+    # The copy shares the transition tables, but has its own state and memory
+    f = copy.copy(line_lexer)
+    f.memory = ['']
     f.process_list(line)
     if len(f.memory) > 0 and f.memory[-1] == '':
         del f.memory[-1]
 
     return f.memory
 
+class LineTokenizer(object):
+    """
+    Tokenize successive versions of a line being edited, lexing each version
+    only from the last checkpoint before its first changed character.
+
+    The checkpoints are the token boundaries that follow whitespace, where the
+    lexer state is always the same, and the end of the previous version, where
+    the lexer state is saved. Typing at the end of the line thus only lexes the
+    new characters.
+    """
+    def __init__(self):
+        self.line = u''
+        self.lexer = copy.copy(span_lexer)
+        self.lexer.memory = [[None, None]]
+        # (kind, start, end) triples of the tokens that are complete (all but
+        # the last one in the lexer memory)
+        self.complete = []
+
+    def tokenize(self, line):
+        """
+        Tokenize a command line; return the (kind, start, end) triples of the
+        tokens (see parse_line_spans()) and the final lexer state
+        """
+        if line.startswith(self.line):
+            # Resume from the end of the previous line
+            position = len(self.line)
+        else:
+            position = self.resume(line)
+        self.lexer.process_list(line, position)
+        self.line = line
+
+        memory = self.lexer.memory
+        for (start, end) in memory[len(self.complete) : -1]:
+            self.complete.append((token_kind(line, start, end), start, end))
+        (start, end) = memory[-1]
+        if start is None:
+            spans = self.complete[:]
+        else:
+            spans = self.complete + [(token_kind(line, start, end), start, end)]
+        return (spans, self.lexer.current_state)
+
+    def resume(self, line):
+        """
+        Restore the lexer to the last checkpoint in the part that line has in
+        common with the previous line; return the position of the checkpoint
+        """
+        common = 0
+        while common < len(line) and common < len(self.line) and line[common] == self.line[common]:
+            common += 1
+
+        # The tokens that start before the first changed character
+        memory = self.lexer.memory
+        count = len(memory)
+        while count > 0 and (memory[count - 1][0] is None or memory[count - 1][0] >= common):
+            count -= 1
+        if count > 0 and memory[count - 1][1] < common:
+            # Whitespace before the changed character
+            position = common
+        elif count > 0:
+            # Move back to the start of a token that follows whitespace
+            count -= 1
+            while count > 0 and memory[count - 1][1] == memory[count][0]:
+                count -= 1
+            position = memory[count][0] if count > 0 else 0
+        else:
+            position = 0
+
+        del memory[count:]
+        memory.append([None, None])
+        del self.complete[count:]
+        if count > 0:
+            # Whitespace was the last symbol
+            self.lexer.current_state = 'whitespace'
+        else:
+            self.lexer.current_state = self.lexer.initial_state
+        return position
+
+def token_kind(line, start, end):
+    """
+    Return the kind of the token between the given positions of a line:
+    'sequence' (|, ||, & or &&), 'redirect' (e.g. >, 2>>, 2>&1), 'quoted' (a
+    token containing double quotes) or 'word'
+    """
+    first = line[start]
+    if first in '|&':
+        return 'sequence'
+    if first in '<>' or (first in digit_chars and end - start > 1 and line[start + 1] in '<>'):
+        return 'redirect'
+    if line.find('"', start, end) >= 0:
+        return 'quoted'
+    return 'word'
+
+def parse_line_spans(line):
+    """
+    Tokenize a command line like parse_line(), but return (kind, start, end)
+    triples locating the tokens in the line (see token_kind() for the kinds)
+    """
+    return LineTokenizer().tokenize(line)[0]
+
+def parse_completed_line(line):
+    """
+    Tokenize a command line that is being completed, like parse_line_spans();
+    if the last character ends a token (i.e. we are completing a new one), an
+    empty 'word' span is added at the end of the line
+    """
+    (spans, state) = completion_tokenizer.tokenize(line)
+    if spans == [] or (line[-1] in sep_chars and not state in ['in_string', 'escape']):
+        # This saves us some checks later
+        spans.append(('word', len(line), len(line)))
+    return spans
+
+# Successive completions are mostly on the same line, with a few characters
+# typed in between (only used from the main thread)
+completion_tokenizer = LineTokenizer()
+
 def unescape(string):
     """Unescape string from ^ escaping. ^ inside double quotes is ignored"""
     if (string == None):
@@ -205,10 +349,7 @@ def fuzzy_match(substr, str, prefix_only = False):
     """
     #print '\n\nMatch "' + substr + '" in "' + str + '"\n\n'
     words = substr.split(' ')
-    pattern = [('\\b' if prefix_only else '') + '(' + word + ').*' for word in words]
-    # print '\n\n', pattern, '\n\n'
-    pattern = ''.join(pattern)
-    matches = re.search(pattern, str, re.IGNORECASE)
+    matches = WordsPattern(words, prefix_only = prefix_only).search(str)
     return [matches.span(i) for i in range(1, len(words) + 1)] if matches else []
 
 def abbrev_string(string):
@@ -4,10 +4,11 @@
 #    2) names of environment variables
 #
 
-import sys, os, re
-from common import parse_line, expand_env_vars, has_exec_extension, strip_extension
+import sys, os
+from common import parse_completed_line, expand_env_vars, has_exec_extension, strip_extension
 from common import contains_special_char, starts_with_special_char
-from common import sep_chars, seq_tokens
+from fuzzy import WildcardPattern
+from dirlisting import directory_cache, path_index
 
 def complete_file(line):
     """
@@ -44,10 +45,9 @@ def complete_file_simple(line):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
-        tokens += ['']   # This saves us some checks later
-    token = tokens[-1].replace('"', '')
+    spans = parse_completed_line(line)
+    (kind, start, end) = spans[-1]
+    token = line[start : end].replace('"', '')
 
     pos_fwd = expand_env_vars(token).rfind('/')
     pos_bck = expand_env_vars(token).rfind('\\')
@@ -70,35 +70,22 @@ def complete_file_simple(line):
     matcher = wildcard_to_regex(prefix + '*')
 
     completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) 
-                           if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-        
+    listing = directory_cache.get(dir_to_complete)
+    if listing is not None:
+        # Otherwise cannot complete, probably access denied
+        completions = [elem for elem in listing.names if matcher.match(elem)]
 
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + path_sep for elem in completions if os.path.isdir(dir_to_complete + path_sep + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + path_sep + elem)]
+    completions_dirs = [elem + path_sep for elem in completions if listing.is_dir(elem)]
+    completions_files = [elem for elem in completions if listing.is_file(elem)]
     completions = completions_dirs + completions_files
 
-    if (len(tokens) == 1 or tokens[-2] in seq_tokens) and path_to_complete == '':
+    if (len(spans) == 1 or spans[-2][0] == 'sequence') and path_to_complete == '':
         # We are at the beginning of a command ==> also complete from the path
-        completions_path = []
-        for elem_in_path in os.environ['PATH'].split(';'):
-            dir_to_complete = expand_env_vars(elem_in_path) + path_sep
-            try:                
-                completions_path += [elem for elem in os.listdir(dir_to_complete) 
-                                     if matcher.match(elem)
-                                     and os.path.isfile(dir_to_complete + path_sep + elem)
-                                     and has_exec_extension(elem)
-                                     and not elem in completions
-                                     and not elem in completions_path]
-            except OSError:
-                # Cannot complete, probably access denied
-                pass
+        completed = set(completions)
+        completions_path = [elem for elem in path_index.lookup(prefix)
+                            if not elem in completed]
+        completed.update(completions_path)
 
         # Add internal commands
         internal_commands = ['assoc',
@@ -119,8 +106,7 @@ def complete_file_simple(line):
             internal_commands.append('mklink')
         completions_path += [elem for elem in internal_commands
                              if matcher.match(elem)
-                             and not elem in completions
-                             and not elem in completions_path]
+                             and not elem in completed]
 
 
         # Sort in lexical order (case ignored)
@@ -128,16 +114,17 @@ def complete_file_simple(line):
 
         # Remove .com, .exe or .bat extension where possible
         completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
+        similar = {}
+        for elem in completions_path_no_ext + [strip_extension(elem) for elem in completions]:
+            similar[elem] = similar.get(elem, 0) + 1
         completions_path_nice = []
-        for i in range(0, len(completions_path_no_ext)):
-            similar = [elem for elem in completions_path_no_ext if elem == completions_path_no_ext[i]]
-            similar += [elem for elem in completions if strip_extension(elem) == completions_path_no_ext[i]]
-            if len(similar) == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
+        for (elem, elem_no_ext) in zip(completions_path, completions_path_no_ext):
+            if similar[elem_no_ext] == 1 and has_exec_extension(elem) and len(prefix) < len(elem) - 3:
                 # No similar executables, don't use extension
-                completions_path_nice.append(completions_path_no_ext[i])
+                completions_path_nice.append(elem_no_ext)
             else:
                 # Similar executables found, keep extension
-                completions_path_nice.append(completions_path[i])
+                completions_path_nice.append(elem)
         completions += completions_path_nice
 
     if completions != []:
@@ -163,7 +150,7 @@ def complete_file_simple(line):
             start_quote = ''
 
         # Build the result
-        result = line[0 : len(line) - len(tokens[-1])] + start_quote + completed_file
+        result = line[0 : start] + start_quote + completed_file
 
         if len(completions) == 1:
             # We can close the quotes if we have completed to a unique filename
@@ -198,10 +185,9 @@ def complete_file_alternate(line):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
-        tokens += ['']   # This saves us some checks later
-    (last_token_prefix, equal_char, last_token) = tokens[-1].replace('"', '').rpartition('=')
+    spans = parse_completed_line(line)
+    (kind, start, end) = spans[-1]
+    (last_token_prefix, equal_char, last_token) = line[start : end].replace('"', '').rpartition('=')
     last_token_prefix += equal_char
         
     paths = last_token.split(';')
@@ -209,7 +195,7 @@ def complete_file_alternate(line):
 
     path_sep = '/' if '/' in expand_env_vars(token) else '\\'
 
-    # print '\n\nTokens:', tokens, '\n\nCompleting:', token, '\n\n'
+    # print '\n\nTokens:', spans, '\n\nCompleting:', token, '\n\n'
 
     (path_to_complete, _, prefix) = token.rpartition(path_sep)
     if path_to_complete == '' and token != '' and token[0] == path_sep:
@@ -228,18 +214,14 @@ def complete_file_alternate(line):
     matcher = wildcard_to_regex(prefix + '*')
 
     completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) 
-                           if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-        
+    listing = directory_cache.get(dir_to_complete)
+    if listing is not None:
+        # Otherwise cannot complete, probably access denied
+        completions = [elem for elem in listing.names if matcher.match(elem)]
 
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + path_sep for elem in completions if os.path.isdir(dir_to_complete + path_sep + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + path_sep + elem)]
+    completions_dirs = [elem + path_sep for elem in completions if listing.is_dir(elem)]
+    completions_files = [elem for elem in completions if listing.is_file(elem)]
     completions = completions_dirs + completions_files
 
     if completions != []:
@@ -265,7 +247,7 @@ def complete_file_alternate(line):
             start_quote = ''
 
         # Build and return the result
-        result = line[0 : len(line) - len(tokens[-1])]
+        result = line[0 : start]
         result += last_token_prefix + start_quote
         result += last_token[:len(last_token) - len(token)]
         result += completed_file
@@ -286,10 +268,9 @@ def complete_wildcard(line):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
-        tokens += ['']   # This saves us some checks later
-    token = tokens[-1].replace('"', '')
+    spans = parse_completed_line(line)
+    (kind, start, end) = spans[-1]
+    token = line[start : end].replace('"', '')
 
     path_sep = '/' if '/' in expand_env_vars(token) else '\\'
     
@@ -310,17 +291,14 @@ def complete_wildcard(line):
     matcher = wildcard_to_regex(prefix + '*')
 
     completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.listdir(dir_to_complete) if matcher.match(elem)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-
+    listing = directory_cache.get(dir_to_complete)
+    if listing is not None:
+        # Otherwise cannot complete, probably access denied
+        completions = [elem for elem in listing.names if matcher.match(elem)]
 
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem + path_sep for elem in completions if os.path.isdir(dir_to_complete + path_sep + elem)]
-    completions_files = [elem for elem in completions if os.path.isfile(dir_to_complete + path_sep + elem)]
+    completions_dirs = [elem + path_sep for elem in completions if listing.is_dir(elem)]
+    completions_files = [elem for elem in completions if listing.is_file(elem)]
     completions = completions_dirs + completions_files
 
     if completions != []:
@@ -356,7 +334,7 @@ def complete_wildcard(line):
             start_quote = ''
 
         # Build the result
-        result = line[0 : len(line) - len(tokens[-1])] + start_quote + completed_file
+        result = line[0 : start] + start_quote + completed_file
         if len(completions) == 1 or \
                 not common_string.endswith('*') and \
                 max([len(c) for c in completed_suffixes]) == len(common_string) - len(prefix):
@@ -392,12 +370,11 @@ def complete_env_var(line):
         completions
       - the list of all possible completions
     """
-    tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
-        tokens += ['']   # This saves some checks later
+    spans = parse_completed_line(line)
+    (kind, start, end) = spans[-1]
 
     # Account for the VAR=VALUE syntax
-    (token_prefix, equals, token_orig) = tokens[-1].rpartition('=')
+    (token_prefix, equals, token_orig) = line[start : end].rpartition('=')
     token_prefix += equals
 
     if token_orig.count('%') % 2 == 0 and token_orig.strip('"').endswith('%'):
@@ -422,7 +399,7 @@ def complete_env_var(line):
                 quote = '"'
                 break
             
-        result = line[0 : len(line) - len(token_orig)] + quote + lead + '%' + common_string
+        result = line[0 : start + len(token_prefix)] + quote + lead + '%' + common_string
         
         if len(completions) == 1:
             result += '%' + quote
@@ -440,65 +417,38 @@ def find_common_prefix(original, completions):
     Search for the longest common prefix in a list of strings
     Returns the longest common prefix
     """
-    common_len = 0
-    common_string = ''
-    mismatch = False
-    perfect = True
-
-    # Cache lowercase version to avoid repeated calls to str.lower()
+    # The longest common prefix (ignoring case) of all the completions is the
+    # one of the first and last completions in lexicographic order
     completions_lower = [s.lower() for s in completions]
-    common_string_lower = ''
-
-    while common_len < len(completions[0]) and not mismatch:
+    first = min(completions_lower)
+    last = max(completions_lower)
+    common_len = 0
+    while common_len < len(first) and first[common_len] == last[common_len]:
         common_len += 1
-        common_string = completions[0][0:common_len]
-        common_string_lower = completions_lower[0][0:common_len]
-        for i in range(1, len(completions)):
-            completion = completions[i]
-            completion_lower = completions_lower[i]
-            if completion_lower[0:common_len] != common_string_lower:
-                mismatch = True
-            elif completion[0:common_len] != common_string:
-                perfect = False
-    if mismatch:
-        common_string = common_string[:-1]
-        common_len -= 1
-
-    # Try to take a good guess wrt letter casing
-    if not perfect:
-        for i in range(len(original)):
-            case_match = [c for c in completions if c.startswith(original[:i + 1])]
-            if len(case_match) > 0:
-                common_string = case_match[0][:common_len]
-            else:
-                break
+
+    # Try to take a good guess wrt letter casing: use the first completion that
+    # starts with the longest part of the original string
+    case_match = completions[0]
+    case_len = 0
+    for completion in completions:
+        if case_len < len(original) and completion.startswith(original[:case_len + 1]):
+            case_match = completion
+            case_len += 1
+            while (case_len < len(original) and case_len < len(completion)
+                   and completion[case_len] == original[case_len]):
+                case_len += 1
+    common_string = case_match[:common_len]
 
     return common_string
 
 
 def wildcard_to_regex(pattern):
     """
-    Transform a wildcard pattern into a compiled regex object.
-    This also handles escaping as needed.    
+    Transform a wildcard pattern into a matcher object, used like a compiled
+    regex: match() returns the groups matched by the wildcards (see
+    fuzzy.WildcardPattern, which does not backtrack like a regex would)
     """
-    # Transform pattern into regexp
-    translations = [('\\', '\\\\'),
-                    ('(', '\\('), 
-                    (')', '\\)'),
-                    ('[', '\\['), 
-                    (']', '\\]'),
-                    ('.', '\\.'),
-                    ('+', '\\+'),
-                    ('^', '\\^'),
-                    ('$', '\\$'),
-                    ('?', '(.)'), 
-                    ('*', '(.*)')]
-                    
-    re_pattern = pattern
-    for src, dest in translations:
-        re_pattern = re_pattern.replace(src, dest)
-    re_pattern += '$'
-    return re.compile(re_pattern, re.IGNORECASE)
+    return WildcardPattern(pattern)
 
 
 def has_wildcards(pattern):
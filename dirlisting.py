@@ -0,0 +1,255 @@
+#
+# Cached directory listings
+#
+# Completing a file name lists a directory and checks the type of the matching
+# entries; on network drives or in very large directories, doing this on every
+# Tab press is slow. The listings are kept here, keyed by the normalized path
+# of the directory, and read again only once the directory changed (i.e. its
+# modification time did) or they expired.
+#
+# A directory is read in a single scan that also gives the types of the entries
+# (without any further system call, except for the links), with the scandir
+# module if it is installed or else with FindFirstFileW/FindNextFileW.
+#
+# The executables found in the PATH directories are kept in an index sorted by
+# lowercase name, so that completing a command name is a binary search (see
+# ExecutableIndex).
+#
+import os, sys, stat, time, threading
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from common import expand_env_vars, has_exec_extension
+from win32con import FILE_ATTRIBUTE_DIRECTORY, FILE_ATTRIBUTE_REPARSE_POINT
+from win32file import FindFilesW
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# Entry types (see DirectoryListing.entry_type())
+entry_dir = 'dir'
+entry_file = 'file'
+entry_other = 'other'
+
+# Directory modification times can be this coarse (FAT file systems): a
+# listing read less than this many seconds after the last change might have
+# missed another change with the same modification time
+mtime_granularity = 2.0
+
+
+class DirectoryListing(object):
+    """
+    The names of the entries of a directory, and their types as far as they
+    were looked up
+    """
+    def __init__(self, path, mtime, read_time):
+        self.path = path
+        self.mtime = mtime
+        self.read_time = read_time
+        self.names = []
+        self.types = {}
+        if scandir is None:
+            self.find_files(path)
+            return
+        for entry in scandir(path):
+            name = entry.name
+            self.names.append(name)
+            # Like os.path.isdir() and os.path.isfile(), this follows links
+            if entry.is_dir():
+                self.types[name] = entry_dir
+            elif entry.is_file():
+                self.types[name] = entry_file
+            else:
+                self.types[name] = entry_other
+
+    def find_files(self, path):
+        """Read the entries of a directory with FindFilesW()"""
+        # Like os.listdir(), give byte string names for a byte string path
+        encoding = None if isinstance(path, unicode) else sys.getfilesystemencoding()
+        for entry in FindFilesW(os.path.join(path, '*')):
+            (attributes, name) = (entry[0], entry[8])
+            if name in (u'.', u'..'):
+                continue
+            if encoding is not None:
+                name = name.encode(encoding, 'replace')
+            self.names.append(name)
+            # The type of a link is the one of its target: looked up as needed
+            if attributes & FILE_ATTRIBUTE_REPARSE_POINT:
+                continue
+            if attributes & FILE_ATTRIBUTE_DIRECTORY:
+                self.types[name] = entry_dir
+            else:
+                self.types[name] = entry_file
+
+    def entry_type(self, name):
+        """Return the type of an entry: entry_dir, entry_file or entry_other"""
+        entry_type = self.types.get(name)
+        if entry_type is None:
+            full_path = os.path.join(self.path, name)
+            if os.path.isdir(full_path):
+                entry_type = entry_dir
+            elif os.path.isfile(full_path):
+                entry_type = entry_file
+            else:
+                # Special file or dangling link
+                entry_type = entry_other
+            self.types[name] = entry_type
+        return entry_type
+
+    def is_dir(self, name):
+        return self.entry_type(name) == entry_dir
+
+    def is_file(self, name):
+        return self.entry_type(name) == entry_file
+
+
+class DirectoryCache(object):
+    """
+    Directory listings, read again when the modification time of the directory
+    changes or after ttl seconds (for file systems where it can't be trusted);
+    with a ttl of 0, nothing is cached
+    """
+    def __init__(self, ttl = 60, size = 100):
+        self.ttl = ttl
+        self.size = size
+        # Least recently used first
+        self.listings = OrderedDict()
+
+    def get(self, path):
+        """
+        Return the DirectoryListing of a directory, or None if it is not a
+        directory or cannot be listed (e.g. access denied)
+        """
+        # Byte string and unicode paths get listings of the same type
+        key = (os.path.normcase(os.path.abspath(path)), isinstance(path, unicode))
+        listing = self.listings.pop(key, None)
+        try:
+            status = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(status.st_mode):
+            return None
+
+        now = time.time()
+        if (listing is None
+            or listing.mtime != status.st_mtime
+            or listing.read_time - listing.mtime < mtime_granularity
+            or now - listing.read_time >= self.ttl):
+            try:
+                listing = DirectoryListing(path, status.st_mtime, now)
+            except OSError:
+                return None
+
+        if self.ttl > 0:
+            self.listings[key] = listing
+            if len(self.listings) > self.size:
+                self.listings.popitem(last = False)
+        return listing
+
+    def clear(self):
+        """Forget all the listings"""
+        self.listings.clear()
+
+
+# The executables of a PATH value: the (directory, modification time) pairs of
+# its directories, when they were read, and the sorted lowercase names (keys)
+# with the actual names (names)
+PathListing = namedtuple('PathListing', 'path directories read_time keys names')
+
+
+class ExecutableIndex(object):
+    """
+    The executables in the PATH directories, sorted by name (ignoring case).
+    The index is built again for a different PATH value; when one of the
+    directories changed or after ttl seconds, it is built again in the
+    background and the current one is used meanwhile. With a ttl of 0, it is
+    built again for every lookup.
+    """
+    def __init__(self, ttl = 60):
+        self.ttl = ttl
+        self.listing = None
+        self.thread = None
+
+    def lookup(self, prefix, path = None):
+        """
+        Return the executables whose name starts with prefix (ignoring case),
+        sorted by name (ignoring case, then in the order of the PATH)
+        """
+        if path is None:
+            path = os.environ['PATH']
+        listing = self.listing
+        if listing is None or listing.path != path or self.ttl == 0:
+            listing = self.build(path)
+            self.listing = listing
+        elif self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.refresh, args=(listing,))
+            self.thread.daemon = True
+            self.thread.start()
+
+        prefix = prefix.lower()
+        start = bisect_left(listing.keys, prefix)
+        end = start
+        while end < len(listing.keys) and listing.keys[end].startswith(prefix):
+            end += 1
+        return listing.names[start : end]
+
+    def refresh(self, listing):
+        """Thread function: build the index again if it is stale"""
+        try:
+            if self.stale(listing):
+                listing = self.build(listing.path)
+                if self.listing is None or self.listing.path == listing.path:
+                    self.listing = listing
+        except Exception, e:
+            # Not much we can do, keep the current index
+            pass
+
+    def stale(self, listing):
+        """Check whether a PATH directory changed since it was indexed"""
+        if time.time() - listing.read_time >= self.ttl:
+            return True
+        for (directory, mtime) in listing.directories:
+            try:
+                current_mtime = os.stat(directory).st_mtime
+            except OSError:
+                current_mtime = None
+            if current_mtime != mtime:
+                return True
+            if mtime is not None and listing.read_time - mtime < mtime_granularity:
+                # Another change might have kept the same modification time
+                return True
+        return False
+
+    def build(self, path):
+        """Return the PathListing of a PATH value"""
+        now = time.time()
+        directories = []
+        names = []
+        seen = set()
+        for elem_in_path in path.split(';'):
+            if elem_in_path == '':
+                continue
+            directory = expand_env_vars(elem_in_path)
+            try:
+                mtime = os.stat(directory).st_mtime
+                listing = DirectoryListing(directory, mtime, now)
+            except OSError:
+                # Missing, or access denied
+                directories.append((directory, None))
+                continue
+            directories.append((directory, mtime))
+            for name in listing.names:
+                # The first directory wins for each name, as in the PATH search
+                if has_exec_extension(name) and not name in seen and listing.is_file(name):
+                    seen.add(name)
+                    names.append(name)
+
+        # Stable sort: names that only differ in case stay in PATH order
+        names.sort(key=lambda name: name.lower())
+        return PathListing(path, directories, now, [name.lower() for name in names], names)
+
+
+# The listings used by the completion functions
+directory_cache = DirectoryCache()
+path_index = ExecutableIndex()
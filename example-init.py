@@ -162,6 +162,94 @@ behavior.quiet_mode = False
 behavior.completion_mode = 'bash'
 
 
+# Share the command history between PyCmd windows
+#
+# All the windows record their commands in the same history file; when this is
+# set to True, each window also picks up the commands run in the other ones
+# (since it last looked) whenever you start navigating the history, instead of
+# only seeing them the next time PyCmd is started.
+#
+# The default is False:
+#       behavior.shared_history = False
+behavior.shared_history = False
+
+
+# Restrict the history search (Up arrow etc.) to some of the commands
+#
+# Accepted values are 'all' (search the entire history), 'directory' (only the
+# commands that were run in the current directory) and 'successful' (only the
+# commands that succeeded, i.e. returned an ERRORLEVEL of 0). Lines that were
+# only typed (and cleared with Esc) or were recorded by an older version of
+# PyCmd are skipped by the latter two.
+#
+# The default is 'all':
+#       behavior.history_filter = 'all'
+behavior.history_filter = 'all'
+
+
+# Change the order of the history search results
+#
+# With 'recency', the commands that best match the search filter come first,
+# the most recent ones first among equally good matches. With 'frecency', how
+# often and how recently each command was run counts as well: a command run
+# several times this week can come before a slightly better matching one that
+# you haven't run in months.
+#
+# The default is 'recency':
+#       behavior.history_ranking = 'recency'
+behavior.history_ranking = 'recency'
+
+
+# Show the commands you ran in the current directory first when searching the
+# history
+#
+# When set to True, the history search (Up arrow etc.) first goes through the
+# matching commands that were run in the current directory, then through the
+# other ones (each group ordered according to history_ranking).
+#
+# The default is False:
+#       behavior.history_directory_first = False
+behavior.history_directory_first = False
+
+
+# Archive the commands that no longer fit in the history
+#
+# PyCmd keeps the last 2000 commands you ran in memory; when set to True, the
+# older ones are moved to archive files (history.<n>.bin in PyCmd's data
+# directory) instead of being forgotten. The history search goes through the
+# archive once you navigate past all the matching commands in memory.
+#
+# The default is True:
+#       behavior.history_archive = True
+behavior.history_archive = True
+
+
+# Search the history in the background (in milliseconds)
+#
+# So that searching a very large history never freezes the prompt, PyCmd waits
+# at most this long for the next match; meanwhile, it shows the best match
+# found so far and updates it once the search completes. Set it to 0 to search
+# in the foreground, waiting for every match.
+#
+# The default is 30:
+#       behavior.history_search_budget = 30
+behavior.history_search_budget = 30
+
+
+# Cache the directory listings used for completion (in seconds)
+#
+# The listings are read again as soon as the directory modification time
+# changes; on file systems where it cannot be trusted (e.g. some network
+# drives), lower this so that new files show up sooner. Command names are
+# completed from an index of the PATH directories, which is refreshed in the
+# background in the same way. Set it to 0 to read the directories on every
+# completion.
+#
+# The default is 60:
+#       behavior.completion_cache_ttl = 60
+behavior.completion_cache_ttl = 60
+
+
 # Remember, you can do whatever you want in this Python script!
 #
 # Also note that you can directly output colored text via the color
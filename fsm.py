@@ -40,7 +40,8 @@ default transition.
 
 When an action function is called it is passed a reference to the FSM. The
 action function may then access attributes of the FSM such as input_symbol,
-current_state, or "memory". The "memory" attribute can be any object that you
+current_state, or "memory"; when processing a list, input_index is the index of
+input_symbol in the list. The "memory" attribute can be any object that you
 want to pass along to the action functions. It is not used by the FSM itself.
 For parsing you would typically pass a list to be used as a stack.
 
@@ -76,9 +77,16 @@ Finally, if none of the previous cases are defined for an input_symbol and
 current_state then the FSM will raise an exception. This may be desirable, but
 you can always prevent this just by defining a default transition.
 
+Once all the transitions are added, compile() turns the tables into dense
+lists indexed by small integers, which process_list() then runs through with
+a much tighter loop. Adding a transition afterwards discards the compiled
+tables (until compile() is called again).
+
 Noah Spurrier 20020822
 """
 
+from itertools import islice
+
 class ExceptionFSM(Exception):
 
     """This is the FSM Exception class."""
@@ -89,6 +97,9 @@ class ExceptionFSM(Exception):
     def __str__(self):
         return `self.value`
 
+# Compiled actions of an undefined transition (see FSM.compile())
+undefined_transition = (None,)
+
 class FSM:
 
     """This is a Finite State Machine (FSM).
@@ -109,7 +120,11 @@ class FSM:
         self.state_empty_transitions = {}
         self.default_transition = None
 
+        # Compiled tables (see compile())
+        self.compiled = None
+
         self.input_symbol = None
+        self.input_index = None
         self.initial_state = initial_state
         self.current_state = self.initial_state
         self.next_state = None
@@ -141,6 +156,7 @@ class FSM:
         if next_state is None:
             next_state = state
         self.state_transitions[(input_symbol, state)] = (action, next_state)
+        self.compiled = None
 
     def add_transition_list (self, list_input_symbols, state, action=None, next_state=None):
 
@@ -175,6 +191,7 @@ class FSM:
         if next_state is None:
             next_state = state
         self.state_transitions_any [state] = (action, next_state)
+        self.compiled = None
 
     def add_empty_transition(self, state, next_state, action = None):
 
@@ -194,6 +211,7 @@ class FSM:
 
         if next_state is not None:
             self.state_empty_transitions[state] = (action, next_state)
+        self.compiled = None
 
     def set_default_transition (self, action, next_state):
 
@@ -207,6 +225,7 @@ class FSM:
         default_transition to None. """
 
         self.default_transition = (action, next_state)
+        self.compiled = None
 
     def get_transition (self, input_symbol, state):
 
@@ -263,10 +282,117 @@ class FSM:
         self.current_state = self.next_state
         self.next_state = None
 
-    def process_list (self, input_symbols):
+    def process_list (self, input_symbols, start=0):
 
         """This takes a list and sends each element to process(). The list may
-        be a string or any iterable object. """
-
-        for s in input_symbols:
-            self.process (s)
+        be a string or any iterable object. With start, the elements before
+        this index are skipped (but input_index still counts them), so that
+        the processing of a list can be resumed from a saved state.
+
+        If the FSM is compiled, the compiled tables are used instead, with the
+        same results, except that the input_symbol, input_index, action and
+        next_state attributes are only updated for the symbols that call
+        actions. """
+
+        if self.compiled is None:
+            for (self.input_index, s) in enumerate(islice(input_symbols, start, None), start):
+                self.process (s)
+            return
+
+        (state_ids, states, symbol_classes, table) = self.compiled
+        get_class = symbol_classes.get
+        state = state_ids[self.current_state]
+        for (index, s) in enumerate(islice(input_symbols, start, None), start):
+            (actions, next_state) = table[state][get_class(s, 0)]
+            if actions:
+                if actions is undefined_transition:
+                    raise ExceptionFSM ('Transition is undefined: (%s, %s).' %
+                        (str(s), str(states[state])) )
+                self.input_symbol = s
+                self.input_index = index
+                self.current_state = states[state]
+                for action in actions:
+                    action (self)
+            state = next_state
+        self.current_state = states[state]
+
+    def compile (self):
+
+        """This precomputes the transitions of every state for every input
+        symbol, so that process_list() only needs two list lookups per symbol:
+
+        - the states are numbered;
+        - the input symbols that have specific transitions each get their own
+          class number, all the others share class 0 (they can only take the
+          "any", empty or default transitions);
+        - the transition of each (state, class) pair is resolved in the same
+          way as get_transition() does, with the empty transitions followed:
+          it is stored as the actions to call in turn (the ones of the empty
+          transitions, then the one of the final transition) and the final
+          next state.
+
+        Changing the transitions afterwards discards the compiled tables. """
+
+        # Number the states and the classes of input symbols
+        states = [self.initial_state]
+        symbol_classes = {}
+        for (input_symbol, state) in self.state_transitions.keys():
+            if not input_symbol in symbol_classes:
+                symbol_classes[input_symbol] = len(symbol_classes) + 1
+            states.append(state)
+        states += self.state_transitions_any.keys() + self.state_empty_transitions.keys()
+        transitions = (self.state_transitions.values() +
+                       self.state_transitions_any.values() +
+                       self.state_empty_transitions.values())
+        if self.default_transition is not None:
+            transitions.append(self.default_transition)
+        states += [next_state for (action, next_state) in transitions]
+        unique_states = []
+        for state in states:
+            if not state in unique_states:
+                unique_states.append(state)
+        states = unique_states
+        state_ids = dict([(states[i], i) for i in range(len(states))])
+
+        # One representative input symbol per class (a symbol that has no
+        # specific transition for class 0)
+        class_symbols = [object()] * (len(symbol_classes) + 1)
+        for (input_symbol, symbol_class) in symbol_classes.items():
+            class_symbols[symbol_class] = input_symbol
+
+        table = []
+        for state in states:
+            row = []
+            for input_symbol in class_symbols:
+                row.append(self.resolve_transition (input_symbol, state, state_ids))
+            table.append(row)
+        self.compiled = (state_ids, states, symbol_classes, table)
+
+    def resolve_transition (self, input_symbol, state, state_ids):
+
+        """This returns the (actions, next state number) of a compiled
+        transition (see compile()). """
+
+        actions = []
+        seen = []
+        while True:
+            if (input_symbol, state) in self.state_transitions:
+                (action, next_state) = self.state_transitions[(input_symbol, state)]
+            elif state in self.state_transitions_any:
+                (action, next_state) = self.state_transitions_any[state]
+            elif state in self.state_empty_transitions:
+                if state in seen:
+                    raise ExceptionFSM ('Circular empty transitions: %s.' % str(state))
+                seen.append(state)
+                (action, state) = self.state_empty_transitions[state]
+                if action is not None:
+                    actions.append(action)
+                continue
+            elif self.default_transition is not None:
+                (action, next_state) = self.default_transition
+            else:
+                # Raised by process_list() if it gets here
+                return (undefined_transition, state_ids[state])
+            if action is not None:
+                actions.append(action)
+            return (tuple(actions), state_ids[next_state])
@@ -0,0 +1,229 @@
+#
+# Fuzzy matching in linear time
+#
+# Regexes such as '(first).*(second).*' or the ones built from wildcards
+# backtrack a lot on long strings where the words (or the literal parts) repeat.
+# The matchers here find the same groups as these regexes but without
+# backtracking. They look like compiled regexes to the code that uses them:
+# search()/match() return a Match, or None.
+#
+# This module also scores the matches, preferring the ones at the start of
+# words, at camel case humps and close to each other (see alignment_score()).
+#
+import string
+
+# Characters matched by \w in a (non-unicode) regex
+word_chars = frozenset(string.ascii_letters + string.digits + '_')
+
+# Scores of the matched characters (see alignment_score())
+score_match = 16
+score_gap_start = -3
+score_gap_extension = -1
+bonus_boundary = 8          # First character of a word
+bonus_camel_case = 7        # Uppercase after lowercase, digit after non-digit
+bonus_consecutive = 4       # Right after the previous matched character
+bonus_first_char_multiplier = 2
+
+
+class Match(object):
+    """
+    The groups found by a matcher, as (start, end) spans in the string; this
+    has the methods of a regex match object that PyCmd uses
+    """
+    def __init__(self, string, spans):
+        self.string = string
+        self.spans = spans
+        self.lastindex = len(spans) if spans else None
+
+    def span(self, group):
+        return self.spans[group - 1]
+
+    def start(self, group):
+        return self.spans[group - 1][0]
+
+    def end(self, group):
+        return self.spans[group - 1][1]
+
+    def group(self, group):
+        (start, end) = self.spans[group - 1]
+        return self.string[start : end]
+
+    def groups(self):
+        return tuple([self.string[start : end] for (start, end) in self.spans])
+
+
+class WordsPattern(object):
+    """
+    Find words in order, anywhere in a string and ignoring case, like a regex
+    search for '(word1).*(word2).*...'. With separators, each word after the
+    first one must follow one of these characters, like a regex search for
+    '(word1).*[separators]+(word2).*...'; with prefix_only, each word must
+    start at a word boundary, like '\\b(word1).*\\b(word2).*...'.
+    """
+    def __init__(self, words, separators = None, prefix_only = False):
+        self.words = [w.lower() for w in words]
+        self.separators = frozenset(separators) if separators is not None else None
+        self.prefix_only = prefix_only
+
+    def search(self, string):
+        """Return the Match of the words in string (or None)"""
+        lower = string.lower()
+        if not self.words:
+            return Match(string, [])
+
+        # Like the regex, take the first occurrence of the first word that
+        # leaves room for the others, and put each of the others as far right
+        # as possible: the positions of the others are found backwards
+        positions = []
+        limit = len(lower)
+        for word in reversed(self.words[1:]):
+            pos = self.find_last(lower, word, limit)
+            if pos < 0:
+                return None
+            positions.append(pos)
+            limit = pos - 1 if self.separators is not None else pos
+        pos = lower.find(self.words[0])
+        while pos >= 0 and not self.allowed(lower, pos, self.words[0], True):
+            pos = lower.find(self.words[0], pos + 1)
+        if pos < 0 or pos + len(self.words[0]) > limit:
+            return None
+        positions.append(pos)
+
+        positions.reverse()
+        return Match(string, [(pos, pos + len(word))
+                              for (pos, word) in zip(positions, self.words)])
+
+    def find_last(self, lower, word, limit):
+        """Return the last allowed position of a word ending before limit (or -1)"""
+        end = limit
+        while end >= 0:
+            pos = lower.rfind(word, 0, end)
+            if pos < 0 or self.allowed(lower, pos, word):
+                return pos
+            end = pos + len(word) - 1
+        return -1
+
+    def allowed(self, lower, pos, word, first = False):
+        """Check whether a word can be matched at the given position"""
+        if self.separators is not None and not first:
+            if pos == 0 or not lower[pos - 1] in self.separators:
+                return False
+        if self.prefix_only:
+            before = pos > 0 and lower[pos - 1] in word_chars
+            after = pos < len(lower) and lower[pos] in word_chars
+            if before == after:
+                return False
+        return True
+
+
+class WildcardPattern(object):
+    """
+    Match an entire string against a shell pattern, ignoring case: '?' matches
+    any character and '*' any sequence of characters. The groups are what the
+    wildcards matched, in the same way as with the regex where each '?' is
+    replaced with '(.)' and each '*' with '(.*)' (i.e. each '*' matches as much
+    as possible).
+    """
+    def __init__(self, pattern):
+        # The parts between the '*' wildcards
+        self.segments = pattern.lower().split('*')
+
+    def match(self, string):
+        """Return the Match of the pattern with string (or None)"""
+        lower = string.lower()
+        segments = self.segments
+        first = segments[0]
+        if not self.segment_at(lower, first, 0):
+            return None
+        if len(segments) == 1:
+            if len(lower) != len(first):
+                return None
+            return Match(string, self.segment_spans(first, 0))
+
+        # The last part is at the end, and each '*' takes as much as it can:
+        # each part before is as far right as possible
+        positions = [len(lower) - len(segments[-1])]
+        if positions[0] < len(first) or not self.segment_at(lower, segments[-1], positions[0]):
+            return None
+        for segment in reversed(segments[1:-1]):
+            pos = self.find_last(lower, segment, positions[-1] - len(segment), len(first))
+            if pos < 0:
+                return None
+            positions.append(pos)
+        positions.append(0)
+        positions.reverse()
+
+        spans = []
+        for i in range(len(segments)):
+            spans += self.segment_spans(segments[i], positions[i])
+            if i < len(segments) - 1:
+                spans.append((positions[i] + len(segments[i]), positions[i + 1]))
+        return Match(string, spans)
+
+    def segment_at(self, lower, segment, pos):
+        """Check whether a part of the pattern matches at the given position"""
+        if pos < 0 or pos + len(segment) > len(lower):
+            return False
+        if not '?' in segment:
+            return lower.startswith(segment, pos)
+        for i in range(len(segment)):
+            if segment[i] != '?' and segment[i] != lower[pos + i]:
+                return False
+        return True
+
+    def find_last(self, lower, segment, pos, lowest):
+        """
+        Return the last position (from pos down to lowest) where a part of the
+        pattern matches (or -1)
+        """
+        if not '?' in segment:
+            pos = lower.rfind(segment, lowest, pos + len(segment))
+            return pos if pos >= 0 else -1
+        while pos >= lowest:
+            if self.segment_at(lower, segment, pos):
+                return pos
+            pos -= 1
+        return -1
+
+    def segment_spans(self, segment, pos):
+        """Return the spans of the '?' wildcards of a part matched at pos"""
+        return [(pos + i, pos + i + 1) for i in range(len(segment)) if segment[i] == '?']
+
+
+def alignment_score(string, spans):
+    """
+    Score how well the given (start, end) spans of a string, e.g. the groups
+    of a Match, match a search: higher for spans at the start of words and
+    camel case humps, and for shorter gaps between the spans. The characters
+    of a span are consecutive matches.
+
+    This scores the alignment as given (e.g. the one that is highlighted), it
+    does not look for a better one.
+    """
+    score = 0
+    previous = None
+    for (start, end) in spans:
+        for pos in xrange(start, end):
+            bonus = char_bonus(string, pos)
+            if previous is None:
+                bonus *= bonus_first_char_multiplier
+            elif pos == previous + 1:
+                bonus = max(bonus, bonus_consecutive)
+            else:
+                score += score_gap_start + score_gap_extension * (pos - previous - 2)
+            score += score_match + bonus
+            previous = pos
+    return score
+
+
+def char_bonus(string, pos):
+    """Return the bonus for matching the character at the given position"""
+    char = string[pos]
+    if not char.isalnum():
+        return 0
+    if pos == 0 or not string[pos - 1].isalnum():
+        return bonus_boundary
+    before = string[pos - 1]
+    if (before.islower() and char.isupper()) or (not before.isdigit() and char.isdigit()):
+        return bonus_camel_case
+    return 0
@@ -322,10 +322,67 @@ class Behavior(_Settings):
         # Select the completion mode; currently supported: 'bash'
         self.completion_mode = 'bash'
 
+        # Pick up the commands run in other PyCmd windows before each
+        # history search (instead of only at startup)
+        self.shared_history = False
+
+        # Only search the history for the commands run in the current
+        # directory ('directory') or the successful ones ('successful');
+        # 'all' searches the entire history
+        self.history_filter = 'all'
+
+        # Order of the history search results: 'recency' (best matches first,
+        # then the most recent ones) or 'frecency' (best matches of the most
+        # frequently and recently run commands first)
+        self.history_ranking = 'recency'
+
+        # Return the history search results for the commands run in the
+        # current directory before the other ones
+        self.history_directory_first = False
+
+        # Keep the commands that no longer fit in the history in an archive
+        # on disk, which is searched once all the other matches were shown
+        self.history_archive = True
+
+        # Search the history in the background, waiting at most this many
+        # milliseconds for a match before showing the best one found so far
+        # (0 searches in the foreground)
+        self.history_search_budget = 30
+
+        # Read the directory listings used for completion (and the PATH
+        # directories, for command names) again after this many seconds, even
+        # if the directories look unchanged (0 reads them on every completion)
+        self.completion_cache_ttl = 60
+
     def sanitize(self):
         if not self.completion_mode in ['bash']:
             print 'Invalid setting "' + self.completion_mode + '" for "completion_mode" -- using default "bash"'
             self.completion_mode = 'bash'
+        if not isinstance(self.shared_history, bool):
+            print 'Invalid setting "' + str(self.shared_history) + '" for "shared_history" -- using default False'
+            self.shared_history = False
+        if not self.history_filter in ['all', 'directory', 'successful']:
+            print 'Invalid setting "' + str(self.history_filter) + '" for "history_filter" -- using default "all"'
+            self.history_filter = 'all'
+        if not self.history_ranking in ['recency', 'frecency']:
+            print 'Invalid setting "' + str(self.history_ranking) + '" for "history_ranking" -- using default "recency"'
+            self.history_ranking = 'recency'
+        if not isinstance(self.history_directory_first, bool):
+            print 'Invalid setting "' + str(self.history_directory_first) + '" for "history_directory_first" -- using default False'
+            self.history_directory_first = False
+        if not isinstance(self.history_archive, bool):
+            print 'Invalid setting "' + str(self.history_archive) + '" for "history_archive" -- using default True'
+            self.history_archive = True
+        if (isinstance(self.history_search_budget, bool)
+            or not isinstance(self.history_search_budget, (int, long, float))
+            or self.history_search_budget < 0):
+            print 'Invalid setting "' + str(self.history_search_budget) + '" for "history_search_budget" -- using default 30'
+            self.history_search_budget = 30
+        if (isinstance(self.completion_cache_ttl, bool)
+            or not isinstance(self.completion_cache_ttl, (int, long, float))
+            or self.completion_cache_ttl < 0):
+            print 'Invalid setting "' + str(self.completion_cache_ttl) + '" for "completion_cache_ttl" -- using default 60'
+            self.completion_cache_ttl = 60
 
 
 # Initialize global configuration instances with default values
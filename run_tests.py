@@ -1,5 +1,5 @@
 import unittest
-from tests import common_tests, completion_tests, console_tests, InputState_tests
+from tests import common_tests, completion_tests, console_tests, InputState_tests, CommandHistory_tests, fuzzy_tests, dirlisting_tests, HistoryWriter_tests, PyCmd_tests
 
 def suite():
     suite = unittest.TestSuite()
@@ -7,6 +7,11 @@ def suite():
     suite.addTest(completion_tests.suite())
     suite.addTest(console_tests.suite())
     suite.addTest(InputState_tests.suite())
+    suite.addTest(CommandHistory_tests.suite())
+    suite.addTest(fuzzy_tests.suite())
+    suite.addTest(dirlisting_tests.suite())
+    suite.addTest(HistoryWriter_tests.suite())
+    suite.addTest(PyCmd_tests.suite())
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+#
+# Benchmark for the history search in CommandHistory.py
+#
+# Run from the top-level directory:
+#    python -m tests.CommandHistory_benchmark [size ...]
+#
+# For each history size, this compares the current CommandHistory with the
+# original list-based implementation (where start() de-duplicates by scanning
+# the results for each matched line and add() does a linear search) when
+# loading the history, searching for the first time (which indexes the loaded
+# history), adding lines and searching with a few typical filters (up to showing
+# the first match).
+# Measurements of the original implementation that would take too long are
+# skipped.
+#
+
+import re, sys, time, random
+from CommandHistory import CommandHistory
+
+class ListHistory:
+    """The original, list-based history search"""
+    def __init__(self):
+        self.list = []
+        self.filtered_list = []
+
+    def load(self, lines):
+        self.list = list(lines)
+
+    def start(self, line):
+        words = [re.escape(w) for w in re.findall('[^\\s]+', line)]
+        boundary = '[\\s]+'
+        patterns = ['^' + boundary.join(['(' + word + ')[^\\s]*' for word in words]) + '$',
+                    boundary.join(['(' + word + ')[^\\s]*' for word in words])]
+        words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)]
+        boundary = '[\\s\\.\\-\\\\_]+'
+        patterns += ['^' + boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]) + '$',
+                     boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]),
+                     '(' + re.escape(line) + ')',
+                     boundary.join(['(' + word + ').*' for word in words]),
+                     ''.join(['(' + word + ').*' for word in words])]
+        if len(words) <= 1:
+            patterns = [patterns[4]]
+
+        self.filtered_list = []
+        for pattern in patterns:
+            for line in reversed(self.list):
+                if line in [l for (l, p) in self.filtered_list]:
+                    continue
+                matches = re.search(pattern, line, re.IGNORECASE)
+                if matches:
+                    self.filtered_list.insert(0, (line, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
+
+    def up(self):
+        return self.filtered_list.pop() if self.filtered_list else None
+
+    def add(self, line):
+        if line in self.list:
+            self.list.remove(line)
+        self.list.append(line)
+
+
+templates = ['git checkout feature-%d',
+             'git commit -m "Fix issue #%d"',
+             'cd c:\\Work\\project%d\\src',
+             'make -j4 target%d',
+             'python setup.py test --case=%d',
+             'notepad build%d.log',
+             'grep -r "TODO %d" .',
+             'ping -n 1 10.0.%d.1']
+
+filters = [('selective', 'git ch 123'),
+           ('one word', 'project42'),
+           ('broad', 'make')]
+
+# Matches of the broad filter make the original start() quadratic; don't
+# bother measuring it above this many history lines
+max_quadratic_size = 100000
+
+def generate(size):
+    """Generate a synthetic history with (mostly) unique lines"""
+    rnd = random.Random(size)
+    return [rnd.choice(templates) % rnd.randint(0, size) for i in xrange(size)]
+
+def measure(action, repeat = 1):
+    """Return the average duration (in ms) of an action"""
+    start = time.time()
+    for i in xrange(repeat):
+        action()
+    return (time.time() - start) * 1000.0 / repeat
+
+def benchmark(size):
+    lines = generate(size)
+    to_add = [lines[i] for i in xrange(0, size, size / 50)] + generate(50)
+    print 'History size: %d' % size
+    print '  %-22s %12s %12s' % ('', 'original', 'current')
+
+    results = []
+    for history in [ListHistory(), CommandHistory()]:
+        timings = [measure(lambda: history.load(lines))]
+        # The first search also indexes the loaded lines
+        timings.append(measure(lambda: (history.start(filters[0][1]), history.up())))
+        timings.append(measure(lambda: [history.add(l) for l in to_add]) / len(to_add))
+        for (name, line) in filters:
+            if (isinstance(history, ListHistory) and name == 'broad'
+                and size > max_quadratic_size):
+                timings.append(None)
+            else:
+                timings.append(measure(lambda: (history.start(line), history.up())))
+        results.append(timings)
+
+    names = ['load', 'first search', 'add'] + ['start (%s)' % name for (name, line) in filters]
+    for i in range(len(names)):
+        print '  %-22s %12s %12s' % tuple([names[i]] + ['%.3f ms' % r[i] if r[i] is not None else 'skipped'
+                                                      for r in results])
+    print
+
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [10000, 100000, 1000000]
+    for size in sizes:
+        benchmark(size)
@@ -0,0 +1,440 @@
+#
+# Unit tests for CommandHistory.py
+#
+
+import re, os, sys, time, shutil, tempfile, subprocess, threading
+from unittest import TestCase, TestSuite, defaultTestLoader
+from CommandHistory import CommandHistory, HistorySearch
+from fuzzy import alignment_score
+import HistoryStore as history_store
+from HistoryStore import HistoryStore, HistoryArchive, HistoryLock, write_history_store, format_record
+
+def reference_search(history, line):
+    """
+    Straightforward version of the history search (one regex pass over the
+    entire history for each pattern, the matches of the last two ordered by
+    the score of their spans); returns the (line, spans) pairs in the order they are
+    visited by pressing Up repeatedly
+    """
+    words = [re.escape(w) for w in re.findall('[^\\s]+', line)]
+    boundary = '[\\s]+'
+    patterns = ['^' + boundary.join(['(' + word + ')[^\\s]*' for word in words]) + '$',
+                boundary.join(['(' + word + ')[^\\s]*' for word in words])]
+    words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)]
+    boundary = '[\\s\\.\\-\\\\_]+'
+    patterns += ['^' + boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]) + '$',
+                 boundary.join(['(' + word + ')[a-zA-Z0-9]*' for word in words]),
+                 '(' + re.escape(line) + ')',
+                 boundary.join(['(' + word + ').*' for word in words]),
+                 ''.join(['(' + word + ').*' for word in words])]
+    if len(words) <= 1:
+        patterns = [patterns[4]]
+
+    result = []
+    for (index, pattern) in enumerate(patterns):
+        matched = []
+        for l in reversed(history):
+            if l in [r for (r, s) in result]:
+                continue
+            matches = re.search(pattern, l, re.IGNORECASE)
+            if matches:
+                matched.append((l, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
+        if index >= 5:
+            matched.sort(key=lambda (l, s): -alignment_score(l, s))
+        result += matched
+    return result
+
+
+class TestHistorySearch(TestCase):
+    """Test the filtering and ordering of history search results"""
+
+    lines = ['git checkout master',
+             'git commit -m "Fix build"',
+             'cd c:\\Work\\build',
+             'make clean',
+             'git status',
+             'grep -r checkout .',
+             'git-cherry-pick master',
+             'notepad build.log',
+             'GIT CHECKOUT maint',
+             'echo ""',
+             'gc m',
+             'make -j4 all']
+
+    filters = ['', 'g', 'git', 'git c', 'g c m', 'c m', 'build', 'BUILD',
+               'uild', 'make all', 'git-ch', 'che', 'xyz', '"', 'a b c d']
+
+    def setUp(self):
+        self.history = CommandHistory()
+        self.history.load(self.lines)
+
+    def navigate(self, line):
+        """Start a search and collect the results by navigating up"""
+        self.history.start(line)
+        result = []
+        while self.history.up():
+            result.append(self.history.current())
+        return result
+
+    def testOrdering(self):
+        """Test that the strongest matches are returned first"""
+        self.assertEqual([l for (l, s) in self.navigate('g c m')][:3],
+                         ['GIT CHECKOUT maint', 'git checkout master', 'git commit -m "Fix build"'])
+
+    def testFuzzyOrdering(self):
+        """Test that the weakest matches are ordered by the score of their spans"""
+        self.history.load(['vim src/xbuild.c', 'cd src\\build', 'ls -l xsrc xbuild'])
+        self.assertEqual([l for (l, s) in self.navigate('src build')],
+                         ['cd src\\build', 'vim src/xbuild.c', 'ls -l xsrc xbuild'])
+
+    def testSpans(self):
+        """Test the spans of the matched filter words"""
+        self.assertEqual(self.navigate('git c')[0],
+                         ('GIT CHECKOUT maint', [(0, 3), (4, 5)]))
+
+    def testReference(self):
+        """Test that the results match a plain search of the entire history"""
+        for line in self.filters:
+            self.assertEqual(self.navigate(line),
+                             reference_search(self.lines, line))
+
+    def testAdd(self):
+        """Test that the results follow lines that are added or moved"""
+        lines = list(self.lines)
+        for line in ['make clean', 'git st', 'git status', 'make clean', 'build']:
+            self.history.add(line)
+            if line in lines:
+                lines.remove(line)
+            lines.append(line)
+            for f in self.filters:
+                self.assertEqual(self.navigate(f), reference_search(lines, f))
+
+    def testRefinement(self):
+        """Test that searches for growing (and shrinking) filters stay exact"""
+        for line in ['g', 'gi', 'git', 'git ', 'git c', 'git ch', 'git c', 'g',
+                     'm', 'ma', 'make', 'make a', 'make al', 'mak', '', 'c', 'c m']:
+            self.assertEqual(self.navigate(line), reference_search(self.lines, line))
+
+    def testNavigation(self):
+        """Test navigating back and forth through the results"""
+        self.history.start('make')
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'make -j4 all')
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'make clean')
+        self.assertFalse(self.history.up())
+        self.assertTrue(self.history.down())
+        self.assertEqual(self.history.current()[0], 'make -j4 all')
+        self.assertTrue(self.history.down())
+        self.assertEqual(self.history.current(), ('make', [(0, 4)]))
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'make -j4 all')
+
+    def testPartialNavigation(self):
+        """Test going back and forth before all the matches are visited"""
+        expected = reference_search(self.lines, 'git')
+        self.history.start('git')
+        for moves in [[1, 1, 1], [-1, -1], [1, 1, 1], [-1], [1, 1]]:
+            for move in moves:
+                if move > 0:
+                    self.assertTrue(self.history.up())
+                else:
+                    self.assertTrue(self.history.down())
+            self.assertEqual(self.history.current(), expected[len(self.history.trail) - 2])
+        self.assertEqual(len(self.history.trail), 6)
+        self.assertFalse(self.history.up())
+
+    def testInfo(self):
+        """Test keeping what we know about the commands"""
+        info = (u'C:\\Work', 1, 2.5, 1000.0)
+        self.history.add('make clean', info)
+        self.assertEqual(self.history.last_info(), info)
+        self.history.add('make all')
+        self.assertEqual(self.history.last_info(), None)
+        self.history.add('make clean')
+        self.assertEqual(self.history.last_info(), info)
+        for i in range(30):
+            # Force a compaction
+            self.history.add('git status')
+            self.history.add('git log')
+        self.history.add('make clean')
+        self.assertEqual(self.history.last_info(), info)
+
+    def testLoadedInfo(self):
+        """Test that adding a loaded line before any search keeps its info"""
+        info = (u'C:\\Work', 2, 2.5, 1000.0)
+        self.history.load(self.lines, [info] * len(self.lines))
+        self.history.add('make clean')
+        self.assertEqual(self.history.last_info(), info)
+
+    def testLoadedUses(self):
+        """Test that running a loaded line before any search keeps its uses"""
+        now = time.time()
+        infos = [(u'C:\\Work', 0, 1.0, now - 60)] * len(self.lines)
+        self.history.load(self.lines, infos, [6.0] * len(self.lines))
+        self.history.add('make clean', (u'C:\\Work', 0, 1.0, now))
+        self.assertAlmostEqual(self.history.last_uses(), 7, 2)
+        self.history.add('git status')
+        self.assertAlmostEqual(self.history.last_uses(), 6, 2)
+
+    def testPrefilter(self):
+        """Test restricting the search to some of the commands"""
+        self.history.add('make all', (u'C:\\Work', 0, 1.0, 100.0))
+        self.history.add('make clean', (u'C:\\Work', 2, 1.0, 101.0))
+        self.history.add('make test', (u'C:\\Other', 0, 1.0, 102.0))
+        self.history.only_cwd = u'C:\\Work'
+        self.assertEqual([l for (l, s) in self.navigate('make')], ['make clean', 'make all'])
+        self.history.only_successful = True
+        self.assertEqual([l for (l, s) in self.navigate('make')], ['make all'])
+        self.history.only_cwd = None
+        self.assertEqual([l for (l, s) in self.navigate('make')], ['make test', 'make all'])
+
+    def testDirectoryFirst(self):
+        """Test returning the commands run in the current directory first"""
+        self.history.add('make all', (u'C:\\Work', 0, 1.0, 100.0))
+        self.history.add('make test', (u'C:\\Other', 0, 1.0, 101.0))
+        self.history.add('git status', (u'C:\\Work', 0, 1.0, 102.0))
+        self.history.first_cwd = u'C:\\Work'
+        self.assertEqual([l for (l, s) in self.navigate('make')],
+                         ['make all', 'make test', 'make -j4 all', 'make clean'])
+        lines = [l for l in self.lines if l != 'git status'] + ['git status']
+        self.assertEqual(self.navigate('git'), reference_search(lines, 'git'))
+        self.history.only_successful = True
+        self.assertEqual([l for (l, s) in self.navigate('make')], ['make all', 'make test'])
+        self.history.first_cwd = u'C:\\Nowhere'
+        self.assertEqual([l for (l, s) in self.navigate('make')], ['make test', 'make all'])
+
+    def testArchive(self):
+        """Test searching the archive after the history"""
+        directory = tempfile.mkdtemp()
+        segment_size = history_store.archive_segment_size
+        try:
+            history_store.archive_segment_size = 4
+            archive = HistoryArchive(os.path.join(directory, 'history'))
+            archive.add(['old make', 'make clean', 'ancient git'])
+            archive.add(['older make'])
+            archive.add(['make old', 'make older'])
+            self.assertEqual([n for (n, f) in archive.segment_files()], [3, 2])
+            self.history.archive = archive
+            self.assertEqual([l for (l, s) in self.navigate('make')],
+                             ['make -j4 all', 'make clean', 'make older', 'make old',
+                              'older make', 'old make'])
+            self.assertEqual(self.navigate('git')[:-1], reference_search(self.lines, 'git'))
+            self.assertEqual(self.navigate('git')[-1], ('ancient git', [(8, 11)]))
+        finally:
+            history_store.archive_segment_size = segment_size
+            shutil.rmtree(directory)
+
+    def testFrecency(self):
+        """Test ranking the matches by frecency"""
+        now = time.time()
+        day = 24 * 3600
+        for i in range(5):
+            self.history.add('make all', (u'C:\\Work', 0, 1.0, now - 30 * day + i))
+        self.history.add('make test', (u'C:\\Work', 0, 1.0, now - day))
+        self.history.add('make clean', (u'C:\\Work', 0, 1.0, now - 60 * day))
+        for i in range(4):
+            self.history.add('make check', (u'C:\\Work', 0, 1.0, now - 60 * (3 - i)))
+        self.assertAlmostEqual(self.history.last_uses(), 4, 2)
+        self.history.ranking = 'frecency'
+        self.assertEqual([l for (l, s) in self.navigate('make')],
+                         ['make check', 'make test', 'make all', 'make clean', 'make -j4 all'])
+        self.history.add('make check')
+        self.assertAlmostEqual(self.history.last_uses(), 4, 2)
+        self.history.ranking = 'recency'
+        self.assertEqual([l for (l, s) in self.navigate('make')],
+                         ['make check', 'make clean', 'make test', 'make all', 'make -j4 all'])
+
+    def testBackground(self):
+        """Test that a background search finds the same matches"""
+        self.history.search_budget = 0
+        for line in self.filters:
+            self.history.start(line)
+            result = []
+            while True:
+                moved = self.history.up()
+                if moved is None:
+                    # Not found yet, wait for the search to complete
+                    self.history.searcher.thread.join()
+                    moved = self.history.refresh()
+                if not moved:
+                    break
+                result.append(self.history.current())
+            self.assertEqual(result, reference_search(self.lines, line))
+
+    def testCancel(self):
+        """Test changing the history while a background search runs"""
+        lines = list(self.lines)
+        self.history.search_budget = 0
+        for line in ['make clean', 'git st', 'git status']:
+            self.history.start('git')
+            self.history.up()
+            self.history.add(line)
+            self.assertEqual(self.history.searcher, None)
+            if line in lines:
+                lines.remove(line)
+            lines.append(line)
+        self.history.search_budget = None
+        for line in self.filters:
+            self.assertEqual(self.navigate(line), reference_search(lines, line))
+
+
+class TestHistoryStoreSearch(TestHistorySearch):
+    """Run the same tests on a history loaded from a binary history file"""
+
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp()
+        os.close(handle)
+        write_history_store(self.filename, self.lines)
+        self.store = HistoryStore(self.filename)
+        self.history = CommandHistory()
+        self.history.load(self.store)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.filename)
+
+    def testStore(self):
+        """Test reading the lines of a binary history file"""
+        self.assertEqual([self.store[i] for i in range(len(self.store))], self.lines)
+        self.assertEqual(self.store[-1], self.lines[-1])
+        self.assertEqual(self.history.list, self.lines)
+        self.assertEqual(self.history.last(), self.lines[-1])
+
+    def testRecords(self):
+        """Test reading what we know about the commands from a binary history file"""
+        info = (u'C:\\Work', 0, 2.5, 1000.0)
+        write_history_store(self.filename, [format_record(l, info, 3.0) for l in self.lines])
+        store = HistoryStore(self.filename)
+        self.history.load(store)
+        self.assertEqual(self.history.list, self.lines)
+        self.assertEqual(self.history.last_info(), info)
+        self.assertEqual(self.history.last_uses(), 3.0)
+        self.history.only_cwd = u'C:\\Work'
+        self.assertEqual(self.navigate('make'), reference_search(self.lines, 'make'))
+        self.history.only_cwd = u'C:\\Other'
+        self.assertEqual(self.navigate('make'), [])
+        self.history.only_cwd = None
+        self.history.add('make test', (u'C:\\Other', 0, 1.0, 2000.0))
+        self.history.first_cwd = u'C:\\Work'
+        self.assertEqual([l for (l, s) in self.navigate('make')],
+                         ['make -j4 all', 'make clean', 'make test'])
+        store.close()
+
+    def testUnindexedRecords(self):
+        """Test adding a line of a binary history file before any search"""
+        info = (u'C:\\Work', 0, 2.5, 1000.0)
+        write_history_store(self.filename, [format_record(l, info, 3.0) for l in self.lines])
+        store = HistoryStore(self.filename)
+        self.history.load(store)
+        self.history.add('git status')
+        self.assertEqual(self.history.last_info(), info)
+        self.assertEqual(self.history.last_uses(), 3.0)
+        self.history.add('make clean', (u'C:\\Other', 0, 1.0, 1000.0))
+        self.assertAlmostEqual(self.history.last_uses(), 4.0, 2)
+        self.history.add('make', (u'C:\\Other', 0, 1.0, 1000.0))
+        self.assertEqual(self.history.last_uses(), 1)
+        # Adding lines does not index the whole store
+        self.assertFalse(self.history.store_indexed)
+        store.close()
+
+    def testFind(self):
+        """Test looking up lines in a binary history file"""
+        lines = self.lines + [u'ls', u'ls -l', u'cd ls', u'x\xe9ls', u'ls\xe9', u'a' * 300]
+        info = (u'C:\\Work', 0, 2.5, 1000.0)
+        write_history_store(self.filename, [format_record(lines[i], info if i % 2 else None)
+                                            for i in range(len(lines))])
+        store = HistoryStore(self.filename)
+        for i in range(len(lines)):
+            self.assertEqual(store.find(lines[i]), i)
+        for line in [u's', u'l', u'ls -', u'-l', u'a' * 299, u'git', u'C:\\Work']:
+            self.assertEqual(store.find(line), None)
+        store.close()
+
+
+class TestHistorySearchThread(TestCase):
+    """Test the notifications of a background search"""
+
+    def start(self):
+        """Start a search whose only match is found once self.found is set"""
+        self.found = threading.Event()
+        self.notified = []
+        def results():
+            self.found.wait()
+            yield ('git status', 0)
+        return HistorySearch(results(), lambda: self.notified.append(True))
+
+    def testNotify(self):
+        """Test that a search that is waited for notifies once it has news"""
+        searcher = self.start()
+        self.assertEqual(searcher.get(0), False)
+        self.found.set()
+        searcher.thread.join()
+        self.assertEqual(self.notified, [True])
+        self.assertEqual(searcher.get(0), ('git status', 0))
+
+    def testCancel(self):
+        """Test that cancelling a search that is waited for never notifies"""
+        searcher = self.start()
+        self.assertEqual(searcher.get(0), False)
+        searcher.cancel()
+        self.found.set()
+        searcher.thread.join()
+        self.assertEqual(self.notified, [])
+
+    def testCancelHistory(self):
+        """Test that resetting the history while up() waits never notifies"""
+        history = CommandHistory()
+        history.load(['git status'])
+        history.search_budget = 0
+        history.notify = lambda: self.notified.append(True)
+        self.notified = []
+        history.start('git')
+        history.cancel()
+        def results():
+            # Like the actual search, this ends when cancelled
+            while not history.cancelled:
+                time.sleep(0.001)
+            yield ('git status', 0)
+        history.searcher = HistorySearch(results(), history.notify)
+        self.assertEqual(history.up(), None)
+        history.reset()
+        self.assertEqual(history.searcher, None)
+        self.assertEqual(self.notified, [])
+
+
+class TestHistoryLock(TestCase):
+    """Test the lock shared by the PyCmd processes"""
+
+    def testTimeout(self):
+        """Test giving up on a lock held by another process"""
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'history')
+        holder = subprocess.Popen([sys.executable, '-c',
+                                   'import sys; sys.path[0:0] = sys.argv[1:2]\n'
+                                   'from HistoryStore import HistoryLock\n'
+                                   'lock = HistoryLock(sys.argv[2]); lock.acquire()\n'
+                                   'print "locked"; sys.stdout.flush(); sys.stdin.read()',
+                                   os.getcwd(), filename],
+                                  stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), 'locked')
+            lock = HistoryLock(filename)
+            start = time.time()
+            self.assertFalse(lock.acquire(0.1))
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        self.assertTrue(lock.acquire(5))
+        lock.release()
+        shutil.rmtree(directory)
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistorySearch))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryStoreSearch))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistorySearchThread))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryLock))
+    return suite
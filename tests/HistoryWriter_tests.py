@@ -0,0 +1,118 @@
+#
+# Unit tests for HistoryWriter.py
+#
+
+import sys, threading
+from StringIO import StringIO
+from unittest import TestCase, TestSuite, defaultTestLoader
+from HistoryWriter import HistoryWriter
+
+class TestHistoryWriter(TestCase):
+    def setUp(self):
+        self.written = []
+        self.failures = []
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def write(self, lines, filename, length):
+        """Record the lines, or raise the next queued failure"""
+        if self.failures:
+            raise self.failures.pop(0)
+        self.written.append(([l + u'\n' for l in lines], filename, length))
+
+    def testCoalescing(self):
+        """Test that the updates queued during a write are written in one go"""
+        started = threading.Event()
+        resume = threading.Event()
+        def write(lines, filename, length):
+            started.set()
+            resume.wait()
+            self.write(lines, filename, length)
+        writer = HistoryWriter(write)
+        writer.update(u'x', 'history', 10)
+        started.wait()
+        for (line, filename) in [(u'a', 'history'), (u'b', 'history'),
+                                 (u'c', 'dir_history'), (u'a', 'history')]:
+            writer.update(line, filename, 10)
+        resume.set()
+        writer.flush()
+        self.assertEqual(self.written, [([u'x\n'], 'history', 10),
+                                        ([u'b\n', u'a\n'], 'history', 10),
+                                        ([u'c\n'], 'dir_history', 10)])
+
+    def testFlush(self):
+        """Test that flush() waits for the queued updates"""
+        writer = HistoryWriter(self.write)
+        for i in range(100):
+            writer.update(u'line %d' % i, 'history', 10)
+        writer.flush()
+        self.assertEqual(sum([len(lines) for (lines, f, l) in self.written]), 100)
+
+    def testRetry(self):
+        """Test that the lines of a failed write are kept for the next burst"""
+        writer = HistoryWriter(self.write)
+        self.failures = [IOError('locked'), OSError('full')]
+        writer.update(u'a', 'history', 10)
+        writer.flush()
+        self.assertEqual(self.written, [])
+        self.assertEqual(writer.pending, {'history': (10, [u'a'])})
+        writer.update(u'b', 'history', 10)
+        writer.flush()
+        self.assertEqual(self.written, [([u'a\n', u'b\n'], 'history', 10)])
+        self.assertEqual(writer.pending, {})
+        # Reported once
+        self.assertEqual(sys.stderr.getvalue().count('PyCmd: can\'t write history'), 1)
+
+    def testBadLine(self):
+        """Test that a line that can't be written is dropped, not retried"""
+        writer = HistoryWriter(self.write)
+        writer.update(u'a', 'history', 10)
+        writer.update(None, 'history', 10)
+        writer.update(u'b', 'history', 10)
+        writer.flush()
+        self.assertEqual([lines for (lines, f, l) in self.written], [[u'a\n'], [u'b\n']])
+        self.assertEqual(writer.pending, {})
+        self.assertTrue('dropped history line None' in sys.stderr.getvalue())
+        writer.update(u'c', 'history', 10)
+        writer.flush()
+        self.assertEqual(self.written[-1], ([u'c\n'], 'history', 10))
+
+    def testUnwritten(self):
+        """Test listing the lines that may not be written yet"""
+        started = threading.Event()
+        resume = threading.Event()
+        def write(lines, filename, length):
+            started.set()
+            resume.wait()
+            self.write(lines, filename, length)
+        writer = HistoryWriter(write)
+        self.failures = [IOError('locked')]
+        writer.update(u'a', 'history', 10)
+        started.wait()
+        writer.update(u'b', 'history', 10)
+        writer.update(u'c', 'dir_history', 10)
+        # Being written, and queued
+        self.assertEqual(writer.unwritten('history'), [u'a', u'b'])
+        resume.set()
+        writer.flush()
+        self.assertEqual(writer.unwritten('history'), [])
+        self.assertEqual(writer.unwritten('dir_history'), [])
+        self.assertEqual(self.written, [([u'a\n', u'b\n'], 'history', 10),
+                                        ([u'c\n'], 'dir_history', 10)])
+
+        # Waiting to be written again
+        self.failures = [IOError('locked')]
+        writer.update(u'd', 'history', 10)
+        writer.queue.join()
+        self.assertEqual(writer.unwritten('history'), [u'd'])
+        writer.flush()
+        self.assertEqual(writer.unwritten('history'), [])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryWriter))
+    return suite
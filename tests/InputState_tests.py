@@ -228,6 +228,20 @@ class TestInputState(TestCase):
         # self.assertEqual(self.state.after_cursor, ' cat log | grep error')
         # self.assertEqual(self.state.selection_start, len(self.state.before_cursor) + len(' cat log | grep error'))
 
+    def testHistoryRefresh(self):
+        """Test that showing a match found in the background clears undo/redo"""
+        self.state.undo = [('mak', '')]
+        self.state.redo = [('make', '')]
+        self.state.history.refresh = lambda timeout = 0: None
+        self.state.key_history_refresh()
+        self.assertEqual(self.state.undo, [('mak', '')])
+
+        self.state.history.refresh = lambda timeout = 0: True
+        self.state.history.current = lambda: ('make clean', [])
+        self.state.key_history_refresh()
+        self.assertEqual(self.state.before_cursor, 'make clean')
+        self.assertEqual((self.state.undo, self.state.redo), ([], []))
+
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestInputState))
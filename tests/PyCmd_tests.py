@@ -0,0 +1,229 @@
+#
+# Unit tests for PyCmd.py
+#
+
+import os, sys, shutil, tempfile
+from StringIO import StringIO
+from unittest import TestCase, TestSuite, defaultTestLoader
+from common import parse_line
+from CommandHistory import CommandHistory
+from HistoryStore import HistoryStore, HistoryArchive, write_history_store
+from HistoryStore import read_history_tail
+from HistoryWriter import HistoryWriter
+from pycmd_public import behavior
+import PyCmd
+
+class TestRunCommand(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.environ = dict(os.environ)
+        (handle, PyCmd.tmpfile) = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(PyCmd.tmpfile)
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def run_line(self, line):
+        """Run a command line the way PyCmd does, return its exit code"""
+        PyCmd.run_command(parse_line(line))
+        return PyCmd.command_exit_code()
+
+    def testExitCode(self):
+        """Test that the exit code of the command itself is recorded"""
+        self.assertEqual(self.run_line('cmd /c exit 3'), 3)
+        self.assertEqual(self.run_line('echo ok > nul'), 0)
+        self.assertNotEqual(self.run_line('dir "' + PyCmd.tmpfile + '.missing" > nul 2>&1'), 0)
+        self.assertEqual(self.run_line('cmd /c exit 0 && cmd /c exit 5'), 5)
+        self.assertEqual(os.environ['ERRORLEVEL'], '5')
+
+
+class Window:
+    """The history of a simulated PyCmd window"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.history = CommandHistory()
+        self.records = {}
+        self.positions = {}
+        self.appends = {}
+        # Nothing gets written in the background: the lines queued by the
+        # tests stay queued
+        self.writer = HistoryWriter(self.write)
+        self.activate()
+        PyCmd.load_history(self.history, filename)
+
+    def write(self, lines, filename, length):
+        """Fail to write, as if the file was locked"""
+        raise IOError('busy')
+
+    def activate(self):
+        """Make PyCmd use the state of this window"""
+        PyCmd.state = self
+        PyCmd.history_records = self.records
+        PyCmd.history_positions = self.positions
+        PyCmd.history_appends = self.appends
+        PyCmd.history_writer = self.writer
+
+    def run(self, line, length = 10):
+        """Add a line to the history and write it, as done after a command"""
+        self.activate()
+        self.history.add(line)
+        PyCmd.write_history([line], self.filename, length)
+
+
+class TestHistoryFiles(TestCase):
+    """Test the history files shared by the PyCmd windows"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # As named by PyCmd
+        self.filename = self.dir + '\\history'
+        self.saved = (behavior.history_archive, PyCmd.save_history_store_limit,
+                      PyCmd.pycmd_data_dir, PyCmd.state, PyCmd.history_writer,
+                      PyCmd.history_records, PyCmd.history_positions,
+                      PyCmd.history_appends, sys.stderr)
+        PyCmd.history_records = {}
+        PyCmd.history_positions = {}
+        PyCmd.history_appends = {}
+        PyCmd.history_archive = HistoryArchive(self.filename)
+        PyCmd.pycmd_data_dir = self.dir
+        behavior.history_archive = True
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        (behavior.history_archive, PyCmd.save_history_store_limit,
+         PyCmd.pycmd_data_dir, PyCmd.state, PyCmd.history_writer,
+         PyCmd.history_records, PyCmd.history_positions,
+         PyCmd.history_appends, sys.stderr) = self.saved
+        PyCmd.history_archive = None
+        shutil.rmtree(self.dir)
+
+    def window(self):
+        """Open a new window on the history file"""
+        if not os.path.isfile(self.filename):
+            open(self.filename, 'w').close()
+        return Window(self.filename)
+
+    def merge(self, window):
+        """Pick up the commands of the other windows, return the history"""
+        window.activate()
+        PyCmd.merge_history()
+        return window.history.list
+
+    def load(self):
+        """Return the lines of the history file, as loaded by a new window"""
+        history = CommandHistory()
+        self.assertTrue(PyCmd.load_history(history, self.filename))
+        lines = history.list
+        if isinstance(history.store, HistoryStore):
+            history.store.close()
+        return lines
+
+    def testStoreLimit(self):
+        """Test that compacting a binary history keeps the lines of the snapshot"""
+        lines = [u'command %d' % i for i in range(3000)]
+        write_history_store(self.filename + '.bin', lines)
+        new_lines = [u'new %d' % i for i in range(25)]
+        # More than twice the length of the history: compacted
+        PyCmd.write_history(new_lines, self.filename, 10)
+        self.assertEqual(PyCmd.history_records[self.filename + '.log'], 0)
+        self.assertEqual(self.load(), lines + new_lines)
+
+        # The lines beyond the limit are archived
+        PyCmd.save_history_store_limit = 3000
+        PyCmd.write_history([u'more %d' % i for i in range(25)], self.filename, 10)
+        self.assertEqual(self.load(), (lines + new_lines)[50:] + [u'more %d' % i for i in range(25)])
+        archived = [list(segment) for segment in PyCmd.history_archive.segments()]
+        self.assertEqual(archived, [lines[:50]])
+
+    def testTail(self):
+        """Test reading the lines appended to a history file"""
+        PyCmd.write_history([u'a', u'b'], self.filename, 10)
+        (records, position) = read_history_tail(self.filename)
+        self.assertEqual(records, [u'a', u'b'])
+        self.assertEqual(read_history_tail(self.filename, position), ([], position))
+        PyCmd.write_history([u'c', u'\xe9'], self.filename, 10)
+        (records, position) = read_history_tail(self.filename, position)
+        self.assertEqual(records, [u'c', u'\xe9'])
+
+        # Partly written lines are left for the next time
+        history_file = open(self.filename, 'ab')
+        history_file.write('d\ne')
+        history_file.close()
+        (records, position) = read_history_tail(self.filename, position)
+        self.assertEqual(records, [u'd'])
+        history_file = open(self.filename, 'ab')
+        history_file.write('\n')
+        history_file.close()
+        self.assertEqual(read_history_tail(self.filename, position)[0], [u'e'])
+
+    def testTailCompacted(self):
+        """Test that reading the tail of a compacted history file fails"""
+        PyCmd.write_history([u'line %d' % i for i in range(20)], self.filename, 10)
+        (records, position) = read_history_tail(self.filename)
+        self.assertEqual(len(records), 20)
+        PyCmd.write_history([u'line 0'], self.filename, 10)
+        self.assertEqual(PyCmd.history_records[self.filename], 10)
+        self.assertEqual(read_history_tail(self.filename, position), (None, position))
+        (records, position) = read_history_tail(self.filename)
+        self.assertEqual(records, [u'line %d' % i for i in range(11, 20)] + [u'line 0'])
+
+    def testMerge(self):
+        """Test picking up the commands of another window"""
+        PyCmd.write_history([u'old'], self.filename, 10)
+        (one, two) = (self.window(), self.window())
+        one.run(u'a')
+        two.run(u'b')
+        two.run(u'old')
+        self.assertEqual(self.merge(one), [u'a', u'b', u'old'])
+        self.assertEqual(self.merge(two), [u'b', u'old', u'a'])
+        self.assertEqual(self.merge(one), [u'a', u'b', u'old'])
+
+    def testMergeOwnLines(self):
+        """Test that the lines written by a window are not merged again"""
+        (one, two) = (self.window(), self.window())
+        # Picked up before its own line is written
+        one.history.add(u'a')
+        two.run(u'b')
+        self.assertEqual(self.merge(one), [u'a', u'b'])
+        one.activate()
+        PyCmd.write_history([u'a'], self.filename, 10)
+        two.run(u'c')
+        self.assertEqual(self.merge(one), [u'a', u'b', u'c'])
+        self.assertFalse(PyCmd.history_appends.get(self.filename))
+
+    def testMergeCompacted(self):
+        """Test that the lines not written yet survive reloading the history"""
+        PyCmd.write_history([u'old'], self.filename, 10)
+        (one, two) = (self.window(), self.window())
+        one.run(u'a')
+        one.history.add(u'queued')
+        one.writer.update(u'queued', self.filename, 10)
+        one.writer.flush()
+        # Compacted by the other window
+        for i in range(20):
+            two.run(u'line %d' % i)
+        self.assertEqual(PyCmd.history_records[self.filename], 10)
+        self.assertEqual(self.merge(one), [u'line %d' % i for i in range(10, 20)] + [u'queued'])
+        self.assertEqual(self.merge(one), [u'line %d' % i for i in range(10, 20)] + [u'queued'])
+
+    def testMergeLocked(self):
+        """Test that merging gives up quickly if the file is locked"""
+        (one, two) = (self.window(), self.window())
+        two.run(u'a')
+        lock = PyCmd.lock_history(self.filename)
+        try:
+            self.assertEqual(self.merge(one), [])
+            self.assertEqual(PyCmd.read_history(self.filename, timeout = 0.05), None)
+        finally:
+            PyCmd.unlock_history(lock)
+        self.assertEqual(self.merge(one), [u'a'])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestRunCommand))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryFiles))
+    return suite
@@ -2,8 +2,10 @@
 # Unit tests for common.py
 #
 
+import copy, random
 from unittest import TestCase, TestSuite, defaultTestLoader
-from common import parse_line, unescape, fuzzy_match
+from common import parse_line, parse_line_spans, unescape, fuzzy_match, line_lexer
+from common import LineTokenizer
 from common import associated_application, full_executable_path, is_gui_application
 
 class TestParseLine(TestCase):
@@ -193,6 +195,52 @@ class TestParseLine(TestCase):
             second_parse = parse_line(' '.join(first_parse))
             self.assertEqual(first_parse, second_parse)
 
+    def testCompiledLexer(self):
+        """Test that the compiled lexer tokenizes like the FSM tables do."""
+        random.seed(1)
+        lines = [input for (input, expected) in self.lines_to_parse]
+        lines += [''.join([random.choice('ab 1\t"^|&<>') for i in range(random.randint(0, 12))])
+                  for j in range(1000)]
+        for line in lines:
+            f = copy.copy(line_lexer)
+            f.compiled = None
+            f.memory = ['']
+            f.process_list(line)
+            if f.memory[-1] == '':
+                del f.memory[-1]
+            self.assertEqual(parse_line(line), f.memory)
+
+    def testParseLineSpans(self):
+        """Test that the spans locate the tokens of parse_line() in the line."""
+        random.seed(2)
+        lines = [input for (input, expected) in self.lines_to_parse]
+        lines += [''.join([random.choice('ab 1\t"^|&<>2') for i in range(random.randint(0, 12))])
+                  for j in range(1000)]
+        for line in lines:
+            self.assertEqual([line[start : end] for (kind, start, end) in parse_line_spans(line)],
+                             parse_line(line))
+
+    def testTokenKinds(self):
+        """Test the kinds of the tokens returned by parse_line_spans()."""
+        line = 'dir "a b" 2>&1 | find x >> "o.txt" && echo 3'
+        self.assertEqual([kind for (kind, start, end) in parse_line_spans(line)],
+                         ['word', 'quoted', 'redirect', 'sequence', 'word', 'word',
+                          'redirect', 'quoted', 'sequence', 'word', 'word'])
+
+    def testLineTokenizer(self):
+        """Test that tokenizing an edited line gives the same spans as from scratch."""
+        random.seed(3)
+        tokenizer = LineTokenizer()
+        line = ''
+        for i in range(5000):
+            position = random.randint(0, len(line))
+            if random.random() < 0.6:
+                line = line[:position] + random.choice('ab 1\t"^|&<>2') + line[position:]
+            else:
+                line = line[:position] + line[position + 2:]
+            self.assertEqual(tokenizer.tokenize(line)[0], parse_line_spans(line), line)
+        self.assertEqual(tokenizer.tokenize(line + 'x')[0], parse_line_spans(line + 'x'))
+
     def testUnescape(self):
         """Test that result of unescape equals expected result."""
         for input, expected in self.strings_to_unescape:
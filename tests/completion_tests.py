@@ -2,9 +2,30 @@
 # Unit tests for completion.py
 #
 
+import random
 from unittest import TestCase, TestSuite, defaultTestLoader
 from completion import wildcard_to_regex, find_common_prefix
 
+def reference_common_prefix(original, completions):
+    """The prefix computed one character at a time (for comparison)"""
+    common_len = 0
+    mismatch = False
+    while common_len < len(completions[0]) and not mismatch:
+        common_len += 1
+        prefix_lower = completions[0][:common_len].lower()
+        mismatch = [c for c in completions if c[:common_len].lower() != prefix_lower] != []
+    if mismatch:
+        common_len -= 1
+    common_string = completions[0][:common_len]
+    for i in range(len(original)):
+        case_match = [c for c in completions if c.startswith(original[:i + 1])]
+        if len(case_match) > 0:
+            common_string = case_match[0][:common_len]
+        else:
+            break
+    return common_string
+
+
 class TestWildcardMatching(TestCase):
     matches = [
         ('abc', 'abc', ()),
@@ -50,6 +71,17 @@ class TestFindCommonPrefix(TestCase):
         for original, completions, result in self.results:
             self.assertEqual(find_common_prefix(original, completions), result)
 
+    def test_reference(self):
+        """Test that the prefix is the same as when computed one character at a time"""
+        random.seed(1)
+        for i in range(5000):
+            completions = [''.join([random.choice('aAbB.') for j in range(random.randint(0, 5))])
+                           for k in range(random.randint(1, 5))]
+            original = ''.join([random.choice('aAbB') for j in range(random.randint(0, 3))])
+            self.assertEqual(find_common_prefix(original, completions),
+                             reference_common_prefix(original, completions),
+                             (original, completions))
+
 
 def suite():
     suite = TestSuite()
@@ -0,0 +1,126 @@
+#
+# Unit tests for dirlisting.py
+#
+
+import os, shutil, tempfile, time
+from unittest import TestCase, TestSuite, defaultTestLoader
+import dirlisting
+from dirlisting import DirectoryCache, DirectoryListing, ExecutableIndex, entry_dir, entry_file
+
+class TestDirectoryCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        open(os.path.join(self.dir, 'file.txt'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def age(self, seconds):
+        """Move the modification time of the directory back"""
+        mtime = time.time() - seconds
+        os.utime(self.dir, (mtime, mtime))
+
+    def testListing(self):
+        """Test the names and types of the entries"""
+        listing = DirectoryCache().get(self.dir)
+        self.assertEqual(sorted(listing.names), ['file.txt', 'sub'])
+        self.assertEqual(listing.entry_type('sub'), entry_dir)
+        self.assertEqual(listing.entry_type('file.txt'), entry_file)
+        self.assertTrue(listing.is_file('file.txt') and not listing.is_dir('file.txt'))
+        self.assertEqual(DirectoryCache().get(os.path.join(self.dir, 'file.txt')), None)
+        self.assertEqual(DirectoryCache().get(os.path.join(self.dir, 'missing')), None)
+
+    def testScan(self):
+        """Test that the types are found while reading the directory"""
+        saved_scandir = dirlisting.scandir
+        dirlisting.scandir = None
+        try:
+            found = DirectoryListing(self.dir, 0, 0)
+            unicode_found = DirectoryListing(unicode(self.dir), 0, 0)
+        finally:
+            dirlisting.scandir = saved_scandir
+        self.assertEqual(found.types, {'sub': entry_dir, 'file.txt': entry_file})
+        self.assertEqual(unicode_found.types, {u'sub': entry_dir, u'file.txt': entry_file})
+        self.assertTrue(all([isinstance(name, unicode) for name in unicode_found.names]))
+        self.assertEqual(sorted(found.names), sorted(os.listdir(self.dir)))
+        if saved_scandir is not None:
+            scanned = DirectoryListing(self.dir, 0, 0)
+            self.assertEqual(scanned.types, found.types)
+
+    def testCaching(self):
+        """Test that listings are reused until the directory changes"""
+        cache = DirectoryCache()
+        self.age(10)
+        listing = cache.get(self.dir)
+        self.assertTrue(cache.get(self.dir + os.sep) is listing)
+        open(os.path.join(self.dir, 'new.txt'), 'w').close()
+        self.age(5)
+        self.assertTrue('new.txt' in cache.get(self.dir).names)
+
+    def testRecentChange(self):
+        """Test that listings read right after a change are not reused"""
+        cache = DirectoryCache()
+        listing = cache.get(self.dir)
+        self.assertFalse(cache.get(self.dir) is listing)
+
+    def testExpiry(self):
+        """Test that listings expire after the TTL"""
+        cache = DirectoryCache(ttl = 0.05)
+        self.age(10)
+        listing = cache.get(self.dir)
+        time.sleep(0.1)
+        self.assertFalse(cache.get(self.dir) is listing)
+        cache.ttl = 0
+        self.assertFalse(cache.get(self.dir) is cache.get(self.dir))
+
+    def testSize(self):
+        """Test that the least recently used listings are dropped"""
+        cache = DirectoryCache(size = 1)
+        self.age(10)
+        cache.get(self.dir)
+        cache.get(os.path.join(self.dir, 'sub'))
+        self.assertEqual(len(cache.listings), 1)
+
+
+class TestExecutableIndex(TestCase):
+    def setUp(self):
+        self.dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for (directory, names) in zip(self.dirs, [['git.exe', 'Gitk.bat', 'gitignore.txt', 'vim.exe'],
+                                                  ['gitk.bat', 'git.exe', 'go.exe']]):
+            for name in names:
+                open(os.path.join(directory, name), 'w').close()
+        os.mkdir(os.path.join(self.dirs[1], 'gcc.exe'))
+        self.path = ';'.join(self.dirs + [os.path.join(self.dirs[0], 'missing')])
+        for directory in self.dirs:
+            os.utime(directory, (time.time() - 10, time.time() - 10))
+
+    def tearDown(self):
+        for directory in self.dirs:
+            shutil.rmtree(directory)
+
+    def testLookup(self):
+        """Test the prefix lookups"""
+        index = ExecutableIndex()
+        self.assertEqual(index.lookup('GI', self.path), ['git.exe', 'Gitk.bat', 'gitk.bat'])
+        self.assertEqual(index.lookup('g', self.path), ['git.exe', 'Gitk.bat', 'gitk.bat', 'go.exe'])
+        self.assertEqual(index.lookup('', self.path), ['git.exe', 'Gitk.bat', 'gitk.bat', 'go.exe', 'vim.exe'])
+        self.assertEqual(index.lookup('x', self.path), [])
+        self.assertEqual(index.lookup('g', self.dirs[1]), ['git.exe', 'gitk.bat', 'go.exe'])
+
+    def testRefresh(self):
+        """Test that the index is built again in the background"""
+        index = ExecutableIndex()
+        self.assertEqual(index.lookup('v', self.path), ['vim.exe'])
+        open(os.path.join(self.dirs[1], 'view.exe'), 'w').close()
+        os.utime(self.dirs[1], (time.time() - 5, time.time() - 5))
+        self.assertEqual(index.lookup('v', self.path), ['vim.exe'])
+        index.thread.join()
+        self.assertEqual(index.lookup('v', self.path), ['view.exe', 'vim.exe'])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestDirectoryCache))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestExecutableIndex))
+    return suite
@@ -0,0 +1,103 @@
+#
+# Unit tests for fuzzy.py
+#
+
+import re, random
+from unittest import TestCase, TestSuite, defaultTestLoader
+from fuzzy import WordsPattern, WildcardPattern, alignment_score
+
+def reference_wildcard(pattern):
+    """The regex equivalent to a wildcard pattern"""
+    regex = ''.join([{'?': '(.)', '*': '(.*)'}.get(c, re.escape(c)) for c in pattern])
+    return re.compile(regex + '$', re.IGNORECASE)
+
+
+def random_string(chars, max_length):
+    """Return a random string of the given characters"""
+    return ''.join([random.choice(chars) for i in range(random.randint(0, max_length))])
+
+
+class TestWordsPattern(TestCase):
+    separators = ' .-\\_'
+
+    def check(self, words, string, separators = None, prefix_only = False):
+        """Compare the spans with the ones of the equivalent regex"""
+        if separators is not None:
+            boundary = '[' + re.escape(separators) + ']+'
+        else:
+            boundary = ''
+        prefix = '\\b' if prefix_only else ''
+        regex = boundary.join([prefix + '(' + re.escape(w) + ').*' for w in words])
+        expected = re.search(regex, string, re.IGNORECASE)
+        match = WordsPattern(words, separators, prefix_only).search(string)
+        if expected is None:
+            self.assertEqual(match, None, (words, string))
+        else:
+            self.assertEqual([match.span(i) for i in range(1, len(words) + 1)],
+                             [expected.span(i) for i in range(1, len(words) + 1)],
+                             (words, string))
+
+    def testWords(self):
+        """Test matching words in order"""
+        self.assertEqual(WordsPattern(['git', 'ma']).search('git checkout master').spans,
+                         [(0, 3), (13, 15)])
+        self.assertEqual(WordsPattern(['ma', 'git']).search('git checkout master'), None)
+        self.assertEqual(WordsPattern(['co', 'ma'], ' ').search('git co-master'), None)
+        self.assertEqual(WordsPattern(['pyc'], prefix_only = True).search('cd ~/pycmd').spans,
+                         [(5, 8)])
+
+    def testReference(self):
+        """Test that the matches are the same as with regexes"""
+        random.seed(1)
+        for i in range(3000):
+            words = [random_string('ab.', 2) for j in range(random.randint(1, 3))]
+            string = random_string('aAb. -_', 12)
+            self.check(words, string)
+            self.check(words, string, self.separators)
+            self.check(words, string, None, True)
+
+    def testLongLine(self):
+        """Test a line that makes the regex backtrack"""
+        line = 'xa' * 20000 + 'b'
+        self.assertEqual(WordsPattern(['a', 'b'], self.separators).search(line), None)
+        self.assertEqual(WordsPattern(['a', 'b']).search(line).spans, [(1, 2), (40000, 40001)])
+
+
+class TestWildcardPattern(TestCase):
+    def testReference(self):
+        """Test that the groups are the same as with regexes"""
+        random.seed(2)
+        for i in range(5000):
+            pattern = random_string('aB.?*', 6)
+            string = random_string('abB.', 8)
+            expected = reference_wildcard(pattern).match(string)
+            match = WildcardPattern(pattern).match(string)
+            if expected is None:
+                self.assertEqual(match, None, (pattern, string))
+            else:
+                self.assertEqual(match.groups(), expected.groups(), (pattern, string))
+                self.assertEqual(match.lastindex, expected.lastindex)
+
+
+class TestAlignmentScore(TestCase):
+    def testBonuses(self):
+        """Test that word starts, camel case and consecutive matches score higher"""
+        self.assertTrue(alignment_score('FooBar', [(0, 1), (3, 4)]) > alignment_score('xfxb', [(1, 2), (3, 4)]))
+        self.assertTrue(alignment_score('foo bar', [(0, 1), (4, 5)]) > alignment_score('foobar', [(0, 1), (3, 4)]))
+        self.assertTrue(alignment_score('xab', [(1, 3)]) > alignment_score('xaxb', [(1, 2), (3, 4)]))
+        self.assertTrue(alignment_score('xaxb', [(1, 2), (3, 4)]) > alignment_score('xaxxxxb', [(1, 2), (6, 7)]))
+        self.assertEqual(alignment_score('abc', []), 0)
+
+    def testMatch(self):
+        """Test scoring the spans found by a matcher"""
+        spans = WordsPattern(['src', 'build']).search('vim src/xbuild.c').spans
+        other = WordsPattern(['src', 'build']).search('ls -l xsrc xbuild').spans
+        self.assertTrue(alignment_score('vim src/xbuild.c', spans) > alignment_score('ls -l xsrc xbuild', other))
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestWordsPattern))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestWildcardPattern))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestAlignmentScore))
+    return suite
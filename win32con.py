@@ -5,11 +5,17 @@ Minimal fill-in for pywin32's win32con module. Defines only the constants used b
 
 ## Win32 Error Codes
 ERROR_SUCCESS = 0
+ERROR_FILE_NOT_FOUND = 2
+ERROR_NO_MORE_FILES = 18
 
 ## File Access Flags
 GENERIC_READ = 0x80000000L
 GENERIC_WRITE = 0x40000000
 
+## File Attributes
+FILE_ATTRIBUTE_DIRECTORY = 0x0010
+FILE_ATTRIBUTE_REPARSE_POINT = 0x0400
+
 ## Console Key Stuff
 RIGHT_ALT_PRESSED = 0x0001  # the right alt key is pressed.
 LEFT_ALT_PRESSED = 0x0002  # the left alt key is pressed.
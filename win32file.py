@@ -0,0 +1,89 @@
+"""
+win32file.py
+Minimal fill-in for pywin32's win32file module. Only FindFilesW is implemented
+(used for the directory listings of the completion, see dirlisting.py).
+"""
+from win32common import *
+from win32con import ERROR_FILE_NOT_FOUND, ERROR_NO_MORE_FILES
+
+#######################
+# Structures & Unions #
+#######################
+
+## Try to import WIN32_FIND_DATAW from ctypes.wintypes or declare our own.
+try:
+    from ctypes.wintypes import WIN32_FIND_DATAW
+except ImportError:
+    class WIN32_FIND_DATAW(Structure):
+        _fields_ = [('dwFileAttributes', DWORD),
+                    ('ftCreationTime', FILETIME),
+                    ('ftLastAccessTime', FILETIME),
+                    ('ftLastWriteTime', FILETIME),
+                    ('nFileSizeHigh', DWORD),
+                    ('nFileSizeLow', DWORD),
+                    ('dwReserved0', DWORD),
+                    ('dwReserved1', DWORD),
+                    ('cFileName', WCHAR * MAX_PATH),
+                    ('cAlternateFileName', WCHAR * 14)]
+
+PWIN32_FIND_DATAW = POINTER(WIN32_FIND_DATAW)
+
+#########################
+# C Function Prototypes #
+#########################
+
+_FindFirstFileW = HANDLEFUNC('FindFirstFileW', [ LPCWSTR, PWIN32_FIND_DATAW ])
+_FindNextFileW = BOOLFUNC('FindNextFileW', [ HANDLE, PWIN32_FIND_DATAW ], checked=False)
+_FindClose = BOOLFUNC('FindClose', [ HANDLE ])
+
+#####################
+# Function Wrappers #
+#####################
+
+def _filetime(filetime):
+    """ Convert a FILETIME to an integer (100-nanosecond intervals since 1601) """
+    return (filetime.dwHighDateTime << 32) | filetime.dwLowDateTime
+
+def FindFilesW(fileSpec):
+    """
+    Retrieves the entries matching a file specification (e.g. 'C:\\Windows\\*'),
+    including '.' and '..' for a directory, in a single FindFirstFileW /
+    FindNextFileW stream. Unlike pywin32, the times are returned as integers
+    (FILETIME values).
+
+    :param fileSpec: The directory or path, with wildcards.
+    :type fileSpec: str|unicode
+    :return: The (attributes, creation time, last access time, last write time, size high, size low, reserved0,
+     reserved1, name, alternate name) tuples of the entries. If the function fails, the standard WinError is raised.
+    :rtype: list
+    """
+    cdata = WIN32_FIND_DATAW()
+    try:
+        chandle = _FindFirstFileW(fileSpec, byref(cdata))
+    except WindowsError, e:
+        if e.winerror == ERROR_FILE_NOT_FOUND:
+            return []
+        raise
+
+    result = []
+    try:
+        while True:
+            result.append((cdata.dwFileAttributes,
+                           _filetime(cdata.ftCreationTime),
+                           _filetime(cdata.ftLastAccessTime),
+                           _filetime(cdata.ftLastWriteTime),
+                           cdata.nFileSizeHigh,
+                           cdata.nFileSizeLow,
+                           cdata.dwReserved0,
+                           cdata.dwReserved1,
+                           cdata.cFileName,
+                           cdata.cAlternateFileName))
+            if not _FindNextFileW(chandle, byref(cdata)):
+                last_error = get_last_error()
+                if last_error != ERROR_NO_MORE_FILES:
+                    raise WinError(last_error)
+                break
+    finally:
+        _FindClose(chandle)
+
+    return result